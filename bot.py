@@ -1,28 +1,49 @@
+import time
+
+_PROCESS_STARTED = time.perf_counter()
+
 import os
 import glob
+import json
+import multiprocessing
+import resource
+import shutil
+import hashlib
+import queue
 import sqlite3
+import threading
 import tempfile
 import asyncio
 import logging
-import numpy as np
+import html
+import re
 import getpass
+import subprocess
 import aiohttp
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, replace
 from datetime import datetime
+from typing import Any, Dict, NamedTuple, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
 from dotenv import load_dotenv
-from moviepy.editor import VideoFileClip, CompositeVideoClip, ImageClip
-from PIL import Image, ImageDraw, ImageFont
-from pilmoji import Pilmoji
-from telethon import TelegramClient, errors
-from telethon.tl.functions.messages import GetAvailableEffectsRequest
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from aiohttp import web
 
-from aiogram import Bot, Dispatcher, types, F, Router
+from aiogram import BaseMiddleware, Bot, Dispatcher, types, F, Router
 from aiogram.enums import ParseMode
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.filters import CommandStart
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.filters import CommandStart, StateFilter
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiogram.types import (
     Message,
     CallbackQuery,
@@ -38,16 +59,93 @@ from aiogram.types import (
     ReplyKeyboardRemove,
 )
 
+# PIL and Pilmoji are only needed for overlays and are imported inside render
+# workers; Telethon is imported by the effects refresh task.
+IMPORT_SECONDS = time.perf_counter() - _PROCESS_STARTED
+
 load_dotenv()
 TOKEN = os.getenv("TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
 DATABASE = os.getenv("DATABASE", "database.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "5"))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "128"))
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+FSM_TTL = int(os.getenv("FSM_TTL", str(2 * 24 * 3600)))
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "1"))
+FSM_EXPIRE_INTERVAL = int(os.getenv("FSM_EXPIRE_INTERVAL", "600"))
 VIDEOS_DIR = os.getenv("VIDEOS", "videos")
+TEMPLATE_UPLOAD_CONCURRENCY = int(os.getenv("TEMPLATE_UPLOAD_CONCURRENCY", "3"))
 CHANNEL_ID = os.getenv("CHANNEL_ID")
 API_ID = os.getenv("API_ID")
 API_HASH = os.getenv("API_HASH")
 PHONE_NUMBER = os.getenv("PHONE_NUMBER")
 TWO_FA_PASSWORD = os.getenv("TWO_FA_PASSWORD")
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", "64"))
+EFFECTS_REFRESH_INTERVAL = int(os.getenv("EFFECTS_REFRESH_INTERVAL", str(6 * 3600)))
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "0")) or os.cpu_count() or 1
+RENDER_QUEUE_SIZE = int(os.getenv("RENDER_QUEUE_SIZE", "32"))
+RENDER_USER_QUEUE_SIZE = int(os.getenv("RENDER_USER_QUEUE_SIZE", "2"))
+FFMPEG_BIN = os.getenv("FFMPEG", "ffmpeg")
+FFPROBE_BIN = os.getenv("FFPROBE", "ffprobe")
+VIDEO_NOTE_SIZE = int(os.getenv("VIDEO_NOTE_SIZE", "640"))
+FONT_PATH = os.getenv("FONT_PATH", "./SF-Pro.ttf")
+FONT_CACHE_SIZE = int(os.getenv("FONT_CACHE_SIZE", "16"))
+FONT_CACHE_BYTES = int(os.getenv("FONT_CACHE_BYTES", str(64 * 1024 * 1024)))
+TEXT_LAYOUT_CACHE_SIZE = int(os.getenv("TEXT_LAYOUT_CACHE_SIZE", "4096"))
+OVERLAY_CACHE_SIZE = int(os.getenv("OVERLAY_CACHE_SIZE", "256"))
+OVERLAY_CACHE_BYTES = int(os.getenv("OVERLAY_CACHE_BYTES", str(64 * 1024 * 1024)))
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", str(256 * 1024)))
+DOWNLOAD_TIMEOUT = int(os.getenv("DOWNLOAD_TIMEOUT", "120"))
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", "3"))
+DOWNLOAD_PART_SIZE = int(os.getenv("DOWNLOAD_PART_SIZE", str(8 * 1024 * 1024)))
+DOWNLOAD_PARALLEL_PARTS = int(os.getenv("DOWNLOAD_PARALLEL_PARTS", "4"))
+COBALT_API_URL = os.getenv("COBALT_API_URL", "http://cobalt-api:9000/")
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "100"))
+HTTP_POOL_PER_HOST = int(os.getenv("HTTP_POOL_PER_HOST", "16"))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "30"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "60"))
+INLINE_CACHE_SIZE = int(os.getenv("INLINE_CACHE_SIZE", "5000"))
+INLINE_CACHE_TTL = int(os.getenv("INLINE_CACHE_TTL", "60"))
+# How long Telegram may reuse an answer on its side, past any invalidation
+INLINE_ANSWER_CACHE_TIME = int(os.getenv("INLINE_ANSWER_CACHE_TIME", "5"))
+INLINE_PAGE_SIZE = int(os.getenv("INLINE_PAGE_SIZE", "20"))
+INLINE_RECENT_LIMIT = int(os.getenv("INLINE_RECENT_LIMIT", "5"))
+LISTING_LIMIT = int(os.getenv("LISTING_LIMIT", "50"))
+LISTING_CONCURRENCY = int(os.getenv("LISTING_CONCURRENCY", "2"))
+# Outgoing messages per second, after https://core.telegram.org/bots/faq
+RATE_LIMIT_GLOBAL = float(os.getenv("RATE_LIMIT_GLOBAL", "30"))
+RATE_LIMIT_CHAT = float(os.getenv("RATE_LIMIT_CHAT", "1"))
+RATE_LIMIT_CHAT_BURST = float(os.getenv("RATE_LIMIT_CHAT_BURST", "3"))
+RATE_LIMIT_GROUP = float(os.getenv("RATE_LIMIT_GROUP", str(20 / 60)))
+RATE_LIMIT_GROUP_BURST = float(os.getenv("RATE_LIMIT_GROUP_BURST", "20"))
+RATE_LIMIT_CHANNEL = float(os.getenv("RATE_LIMIT_CHANNEL", str(20 / 60)))
+RATE_LIMIT_CHANNEL_BURST = float(os.getenv("RATE_LIMIT_CHANNEL_BURST", "20"))
+RATE_LIMIT_CHAT_BUCKETS = int(os.getenv("RATE_LIMIT_CHAT_BUCKETS", "10000"))
+RATE_LIMIT_MAX_RETRIES = int(os.getenv("RATE_LIMIT_MAX_RETRIES", "3"))
+RENDER_CACHE_TTL = int(os.getenv("RENDER_CACHE_TTL", str(30 * 24 * 3600)))
+RENDER_CACHE_MAX_ROWS = int(os.getenv("RENDER_CACHE_MAX_ROWS", "10000"))
+URL_CACHE_TTL = int(os.getenv("URL_CACHE_TTL", str(7 * 24 * 3600)))
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", os.path.join(tempfile.gettempdir(), "wiikotbot-media"))
+MEDIA_CACHE_BYTES = int(os.getenv("MEDIA_CACHE_BYTES", str(2 * 1024 * 1024 * 1024)))
+MEDIA_CACHE_TTL = int(os.getenv("MEDIA_CACHE_TTL", "3600"))
+MEDIA_CACHE_PIN_TTL = int(os.getenv("MEDIA_CACHE_PIN_TTL", str(24 * 3600)))
+SCRATCH_DIR = os.getenv("SCRATCH_DIR")
+SCRATCH_TMPFS = os.getenv("SCRATCH_TMPFS", "0") == "1"
+SCRATCH_MAX_BYTES = int(os.getenv("SCRATCH_MAX_BYTES", str(4 * 1024 * 1024 * 1024)))
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9090"))
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+EVENT_LOOP_LAG_INTERVAL = float(os.getenv("EVENT_LOOP_LAG_INTERVAL", "0.5"))
 
 TEXTS = {
     "welcome": "😸 Welcome to the Video Note Bot!",
@@ -57,11 +155,16 @@ TEXTS = {
     "no_recent_videos": "📭 No recent videos",
     "processing_video_note": "⏳ Processing video note... Please wait...",
     "changes_applied": "👍 Changes applied successfully!",
+    "cancelled": "❌ Cancelled",
+    "your_recent_videos": "🕑 Your recent videos:",
+    "template_deleted": "🗑 Template deleted",
+    "video_deleted": "🗑 Video deleted",
 }
 
 SUCCESS = {
     "text_updated": "✅ Text updated!",
     "caption_updated": "✅ Caption updated!",
+    "effect_updated": "✅ Effect updated!",
     "video_note_created": "✅ Video note created!",
     "template_saved": "✅ Template saved!",
 }
@@ -73,6 +176,8 @@ ERRORS = {
     "error_updating_caption": "❌ Error updating caption",
     "no_video_in_state": "❌ No video data found in state",
     "error_applying_changes": "❌ Error applying changes",
+    "unknown_effect": "❌ There is no effect for this emoji. Try one of: {available}",
+    "render_queue_full": "⏳ Too many videos are being processed right now, please try again in a minute",
 }
 
 BUTTONS = {
@@ -94,9 +199,26 @@ logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 )
 
+# Reply keyboard texts must never be treated as video links or text input
+CONTROL_TEXTS = set(BUTTONS.values())
+MAX_VIDEO_NOTE_DURATION = 60
+MEDIA_GROUP_SIZE = 10
+LISTING_BUTTONS_PER_ROW = 5
+# Hashable so it can be part of overlay cache keys
+OVERLAY_STYLE = (
+    ("fill", "white"),
+    ("stroke_width", 2),
+    ("stroke_fill", "black"),
+    ("line_spacing", 5),
+)
+
 DEFAULT_TEMPLATE_FILE_IDS = []
+DEFAULT_TEMPLATES_LOADED = asyncio.Event()
 AVAILABLE_EFFECTS = {}
+EFFECTS_BY_EMOJI = {}  # emoji without variation selectors -> effect id
+EFFECTS_CATALOG = "message_effects"
 EMPTY_VALUE = "N/A"
+LEGACY_TIMESTAMP_FORMAT = "%d.%m.%Y %H:%M:%S"
 
 # ----- FSM States -----
 class CreateVideoNote(StatesGroup):
@@ -109,11 +231,266 @@ class CreateVideoNote(StatesGroup):
 
 router = Router()
 
-# ----- DATABASE FUNCTIONS -----
-def initialize_db():
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute(
+# ----- METRICS -----
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+STAGE_SECONDS = Histogram(
+    "wiikot_stage_seconds", "Time spent in each stage of a handler",
+    ["handler", "stage"], buckets=LATENCY_BUCKETS,
+)
+HANDLER_ERRORS = Counter(
+    "wiikot_handler_errors", "Handler failures by exception type", ["handler", "error"]
+)
+DOWNLOAD_SECONDS = Histogram(
+    "wiikot_download_seconds", "Media download time", ["origin"], buckets=LATENCY_BUCKETS
+)
+DB_SECONDS = Histogram(
+    "wiikot_db_seconds", "SQLite call time including the wait for a connection",
+    buckets=LATENCY_BUCKETS,
+)
+RENDER_WAIT_SECONDS = Histogram(
+    "wiikot_render_queue_wait_seconds", "Time render jobs spend queued", buckets=LATENCY_BUCKETS
+)
+RENDER_SECONDS = Histogram(
+    "wiikot_render_seconds", "Time render jobs spend on a worker", ["job"], buckets=LATENCY_BUCKETS
+)
+EVENT_LOOP_LAG = Histogram(
+    "wiikot_event_loop_lag_seconds", "How late the event loop wakes up a sleeping task",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+
+
+class StageTimer:
+    """Records how long each consecutive stage of one handler call took."""
+
+    def __init__(self, handler: str):
+        self.handler = handler
+        self.started = self._last = time.perf_counter()
+
+    def mark(self, stage: str):
+        now = time.perf_counter()
+        STAGE_SECONDS.labels(self.handler, stage).observe(now - self._last)
+        self._last = now
+
+    def error(self, exc: BaseException):
+        HANDLER_ERRORS.labels(self.handler, type(exc).__name__).inc()
+
+    def finish(self):
+        STAGE_SECONDS.labels(self.handler, "total").observe(time.perf_counter() - self.started)
+
+
+class BotCollector:
+    """Reads queue depths and in-memory counters at scrape time."""
+
+    def describe(self):
+        # Keeps REGISTRY from calling collect() at import, before the
+        # services it reads are defined
+        return []
+
+    def collect(self):
+        yield GaugeMetricFamily(
+            "wiikot_render_queue_depth", "Render jobs waiting for a worker",
+            value=render_service.queue_depth,
+        )
+        yield GaugeMetricFamily(
+            "wiikot_render_in_flight", "Render jobs running on workers",
+            value=render_service.in_flight,
+        )
+        yield GaugeMetricFamily(
+            "wiikot_url_ingests_in_flight", "Link downloads shared by concurrent requests",
+            value=len(url_ingests),
+        )
+        media = media_cache.stats()
+        yield GaugeMetricFamily(
+            "wiikot_media_cache_bytes", "Size of local source copies", value=media["bytes"]
+        )
+        yield GaugeMetricFamily(
+            "wiikot_media_cache_pinned", "Source copies held by edit sessions",
+            value=media["pinned"],
+        )
+        lookups = CounterMetricFamily(
+            "wiikot_cache_lookups", "Cache lookups by result", labels=["cache", "result"]
+        )
+        worker_caches = render_service.cache_stats()
+        for name, stats in (
+            ("render", RENDER_CACHE_STATS),
+            ("url", URL_CACHE_STATS),
+            ("media", media),
+            ("inline", _inline_cache.stats()),
+            *worker_caches.items(),
+        ):
+            lookups.add_metric([name, "hit"], stats["hits"])
+            lookups.add_metric([name, "miss"], stats["misses"])
+        yield lookups
+        worker_bytes = GaugeMetricFamily(
+            "wiikot_worker_cache_bytes", "Render worker cache sizes, summed over workers",
+            labels=["cache"],
+        )
+        for name, stats in worker_caches.items():
+            worker_bytes.add_metric([name], stats["bytes"])
+        yield worker_bytes
+        yield CounterMetricFamily(
+            "wiikot_media_cache_evictions", "Source copies evicted", value=media["evictions"]
+        )
+        yield CounterMetricFamily(
+            "wiikot_rate_limited_requests", "API calls delayed by the rate limiter",
+            value=rate_limiter.throttled,
+        )
+        yield CounterMetricFamily(
+            "wiikot_flood_wait_retries", "API calls retried after TelegramRetryAfter",
+            value=rate_limiter.retries,
+        )
+
+
+REGISTRY.register(BotCollector())
+
+
+async def monitor_event_loop_lag():
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        EVENT_LOOP_LAG.observe(max(0.0, time.perf_counter() - started - EVENT_LOOP_LAG_INTERVAL))
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+
+async def start_metrics_server() -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get(METRICS_PATH, metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logging.info(f"Serving metrics on {METRICS_HOST}:{METRICS_PORT}{METRICS_PATH}")
+    return runner
+
+
+# ----- DATABASE -----
+class Database:
+    """Pool of long-lived SQLite connections used off the event loop.
+
+    Connections run in WAL mode and keep their compiled statements cached, and
+    every query runs on a small thread pool so handlers never block on disk.
+    """
+
+    def __init__(self, path: str, pool_size: int):
+        self.path = path
+        self.pool_size = pool_size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="sqlite")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=DB_BUSY_TIMEOUT,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE_SIZE,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self._created < self.pool_size
+            if create:
+                self._created += 1
+        if not create:
+            return self._idle.get()
+        try:
+            return self._connect()
+        except BaseException:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    @contextmanager
+    def connection(self):
+        """Borrows a connection; the block runs in one transaction."""
+        conn = self._acquire()
+        try:
+            with conn:
+                yield conn
+        finally:
+            self._idle.put(conn)
+
+    async def run(self, func, *args):
+        """Runs `func(conn, *args)` on the database thread pool."""
+
+        def call():
+            with self.connection() as conn:
+                return func(conn, *args)
+
+        with DB_SECONDS.time():
+            return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+
+    async def execute(self, sql: str, params=()) -> sqlite3.Cursor:
+        return await self.run(lambda conn: conn.execute(sql, params))
+
+    async def executemany(self, sql: str, seq_of_params) -> sqlite3.Cursor:
+        return await self.run(lambda conn: conn.executemany(sql, seq_of_params))
+
+    async def fetchone(self, sql: str, params=(), row_type=None):
+        row = await self.run(lambda conn: conn.execute(sql, params).fetchone())
+        if row is None or row_type is None:
+            return row
+        return row_type._make(row)
+
+    async def fetchall(self, sql: str, params=(), row_type=None) -> list:
+        rows = await self.run(lambda conn: conn.execute(sql, params).fetchall())
+        if row_type is None:
+            return rows
+        return [row_type._make(row) for row in rows]
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        self._created = 0
+
+
+class VideoNote(NamedTuple):
+    id: int
+    user_id: int
+    video_note_file_id: str
+    channel_message_id: int
+    uploaded_video_file_id: str
+    text: Optional[str]
+    caption: Optional[str]
+    effect: Optional[str]
+    duration: Optional[int]
+    width: Optional[int]
+    height: Optional[int]
+    created_at: Optional[int]
+
+
+class Template(NamedTuple):
+    id: int
+    user_id: int
+    video_file_id: str
+    created_at: Optional[int]
+
+
+VIDEO_NOTE_COLUMNS = ", ".join(VideoNote._fields)
+TEMPLATE_COLUMNS = ", ".join(Template._fields)
+# Columns update_video_note_field may touch; the name is interpolated into SQL
+VIDEO_NOTE_UPDATABLE_FIELDS = set(VideoNote._fields) - {"id", "user_id", "created_at"}
+
+db = Database(DATABASE, DB_POOL_SIZE)
+
+
+def _migrate_base_schema(conn: sqlite3.Connection):
+    conn.execute(
         """CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
             username TEXT,
@@ -121,7 +498,7 @@ def initialize_db():
             registration_date TEXT
         )"""
     )
-    cursor.execute(
+    conn.execute(
         """CREATE TABLE IF NOT EXISTS video_notes (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
@@ -137,7 +514,7 @@ def initialize_db():
             created_at TEXT
         )"""
     )
-    cursor.execute(
+    conn.execute(
         """CREATE TABLE IF NOT EXISTS templates (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
@@ -145,20 +522,208 @@ def initialize_db():
             created_at TEXT
         )"""
     )
-    conn.commit()
-    conn.close()
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS render_cache (
+            cache_key TEXT PRIMARY KEY,
+            source_unique_id TEXT NOT NULL,
+            video_note_file_id TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            last_used_at INTEGER NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0
+        )"""
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_render_cache_last_used ON render_cache (last_used_at)"
+    )
+
+
+def _parse_legacy_timestamp(value) -> Optional[int]:
+    if value is None or isinstance(value, (int, float)):
+        return None if value is None else int(value)
+    try:
+        return int(datetime.strptime(value, LEGACY_TIMESTAMP_FORMAT).timestamp())
+    except ValueError:
+        pass
+    try:
+        return int(float(value))
+    except ValueError:
+        logging.warning(f"Dropping unparseable timestamp {value!r}")
+        return None
+
+
+def _migrate_epoch_timestamps(conn: sqlite3.Connection):
+    # "%d.%m.%Y" strings don't sort chronologically and SQLite can't change a
+    # column type in place, so both tables are rebuilt with INTEGER epochs.
+    conn.create_function("legacy_ts", 1, _parse_legacy_timestamp, deterministic=True)
+    conn.execute(
+        """CREATE TABLE video_notes_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            video_note_file_id TEXT NOT NULL,
+            channel_message_id INTEGER NOT NULL,
+            uploaded_video_file_id TEXT NOT NULL,
+            text TEXT,
+            caption TEXT,
+            effect INTEGER,
+            duration INTEGER,
+            width INTEGER,
+            height INTEGER,
+            created_at INTEGER
+        )"""
+    )
+    conn.execute(
+        """INSERT INTO video_notes_new
+           SELECT id, user_id, video_note_file_id, channel_message_id, uploaded_video_file_id,
+           text, caption, effect, duration, width, height, legacy_ts(created_at)
+           FROM video_notes"""
+    )
+    conn.execute("DROP TABLE video_notes")
+    conn.execute("ALTER TABLE video_notes_new RENAME TO video_notes")
+    conn.execute(
+        """CREATE TABLE templates_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            video_file_id TEXT NOT NULL,
+            created_at INTEGER
+        )"""
+    )
+    conn.execute(
+        """INSERT INTO templates_new
+           SELECT id, user_id, video_file_id, legacy_ts(created_at) FROM templates"""
+    )
+    conn.execute("DROP TABLE templates")
+    conn.execute("ALTER TABLE templates_new RENAME TO templates")
+
+
+def _migrate_user_created_indexes(conn: sqlite3.Connection):
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_video_notes_user_created ON video_notes (user_id, created_at)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_templates_user_created ON templates (user_id, created_at)"
+    )
+
+
+def _migrate_fsm_storage(conn: sqlite3.Connection):
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS fsm_storage (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL,
+            updated_at INTEGER NOT NULL
+        )"""
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_fsm_storage_updated ON fsm_storage (updated_at)"
+    )
+
+
+def _migrate_default_templates(conn: sqlite3.Connection):
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS default_templates (
+            path TEXT PRIMARY KEY,
+            sha256 TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            file_id TEXT NOT NULL,
+            updated_at INTEGER NOT NULL
+        )"""
+    )
+
+
+def _migrate_catalog_cache(conn: sqlite3.Connection):
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS catalog_cache (
+            name TEXT PRIMARY KEY,
+            hash INTEGER NOT NULL,
+            payload TEXT NOT NULL,
+            updated_at INTEGER NOT NULL
+        )"""
+    )
+
+
+def _migrate_effect_text(conn: sqlite3.Connection):
+    # Effect ids are 64-bit strings in the Bot API, and INTEGER affinity would
+    # turn them back into numbers, so the column is rebuilt as TEXT.
+    conn.execute(
+        """CREATE TABLE video_notes_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            video_note_file_id TEXT NOT NULL,
+            channel_message_id INTEGER NOT NULL,
+            uploaded_video_file_id TEXT NOT NULL,
+            text TEXT,
+            caption TEXT,
+            effect TEXT,
+            duration INTEGER,
+            width INTEGER,
+            height INTEGER,
+            created_at INTEGER
+        )"""
+    )
+    conn.execute(
+        """INSERT INTO video_notes_new
+           SELECT id, user_id, video_note_file_id, channel_message_id, uploaded_video_file_id,
+           text, caption, CAST(effect AS TEXT), duration, width, height, created_at
+           FROM video_notes"""
+    )
+    conn.execute("DROP TABLE video_notes")
+    conn.execute("ALTER TABLE video_notes_new RENAME TO video_notes")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_video_notes_user_created ON video_notes (user_id, created_at)"
+    )
+
+
+def _migrate_url_cache(conn: sqlite3.Connection):
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS url_cache (
+            url TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            unique_id TEXT NOT NULL,
+            duration INTEGER NOT NULL,
+            created_at INTEGER NOT NULL
+        )"""
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_url_cache_created ON url_cache (created_at)")
 
-def add_user(user_id: int, username: str, first_name: str):
-    reg_date = datetime.now().strftime("%d.%m.%Y %H:%M:%S")
-    with sqlite3.connect(DATABASE) as conn:
-        conn.execute(
-            "INSERT OR IGNORE INTO users (user_id, username, first_name, registration_date) VALUES (?, ?, ?, ?)",
-            (user_id, username, first_name, reg_date),
-        )
-        conn.commit()
 
+# Append only: the position of a migration is its schema version
+MIGRATIONS = [
+    _migrate_base_schema,
+    _migrate_epoch_timestamps,
+    _migrate_user_created_indexes,
+    _migrate_fsm_storage,
+    _migrate_default_templates,
+    _migrate_catalog_cache,
+    _migrate_effect_text,
+    _migrate_url_cache,
+]
 
-def add_video_note(
+
+def initialize_db():
+    with db.connection() as conn:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            logging.info(f"Applying database migration {number}: {migration.__name__}")
+            conn.execute("BEGIN")
+            try:
+                migration(conn)
+                conn.execute(f"PRAGMA user_version = {number}")
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+
+async def add_user(user_id: int, username: str, first_name: str):
+    reg_date = datetime.now().strftime(LEGACY_TIMESTAMP_FORMAT)
+    await db.execute(
+        "INSERT OR IGNORE INTO users (user_id, username, first_name, registration_date) VALUES (?, ?, ?, ?)",
+        (user_id, username, first_name, reg_date),
+    )
+
+
+async def add_video_note(
     user_id: int,
     video_note_file_id: str,
     channel_message_id: int,
@@ -169,307 +734,1718 @@ def add_video_note(
     duration: int,
     width: int,
     height: int,
-):
-    created_at = datetime.now().strftime("%d.%m.%Y %H:%M:%S")
-    with sqlite3.connect(DATABASE) as conn:
+) -> int:
+    created_at = int(time.time())
+    cursor = await db.execute(
+        """INSERT INTO video_notes (user_id, video_note_file_id, channel_message_id, uploaded_video_file_id, text, caption, effect, duration, width, height, created_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        (
+            user_id,
+            video_note_file_id,
+            channel_message_id,
+            uploaded_video_file_id,
+            text,
+            caption,
+            effect,
+            duration,
+            width,
+            height,
+            created_at,
+        ),
+    )
+    invalidate_inline_cache(user_id)
+    return cursor.lastrowid
+
+
+async def get_user_videos(user_id: int, limit: int = 10) -> list:
+    return await db.fetchall(
+        f"""SELECT {VIDEO_NOTE_COLUMNS} FROM video_notes WHERE user_id = ?
+        ORDER BY created_at DESC, id DESC LIMIT ?""",
+        (user_id, limit),
+        row_type=VideoNote,
+    )
+
+
+async def get_video_by_id(video_id: int) -> Optional[VideoNote]:
+    return await db.fetchone(
+        f"SELECT {VIDEO_NOTE_COLUMNS} FROM video_notes WHERE id = ?",
+        (video_id,),
+        row_type=VideoNote,
+    )
+
+
+async def update_video_note_field(video_id: int, field: str, value) -> bool:
+    if field not in VIDEO_NOTE_UPDATABLE_FIELDS:
+        raise ValueError(f"Unknown video note field: {field}")
+    row = await db.fetchone(
+        f"UPDATE video_notes SET {field} = ? WHERE id = ? RETURNING user_id", (value, video_id)
+    )
+    if row:
+        invalidate_inline_cache(row[0])
+    return row is not None
+
+
+async def delete_video(video_id: int):
+    row = await db.fetchone("DELETE FROM video_notes WHERE id = ? RETURNING user_id", (video_id,))
+    if row:
+        invalidate_inline_cache(row[0])
+
+
+# ----- TEMPLATE FUNCTIONS -----
+async def add_template(user_id: int, video_file_id: str):
+    created_at = int(time.time())
+    await db.execute(
+        "INSERT INTO templates (user_id, video_file_id, created_at) VALUES (?, ?, ?)",
+        (user_id, video_file_id, created_at),
+    )
+    invalidate_inline_cache(user_id)
+
+
+async def get_user_templates(user_id: int) -> list:
+    return await db.fetchall(
+        f"SELECT {TEMPLATE_COLUMNS} FROM templates WHERE user_id = ? ORDER BY created_at DESC, id DESC",
+        (user_id,),
+        row_type=Template,
+    )
+
+
+async def delete_template_db(template_id: int, user_id: int) -> bool:
+    row = await db.fetchone(
+        "DELETE FROM templates WHERE id = ? AND user_id = ? RETURNING user_id",
+        (template_id, user_id),
+    )
+    if row:
+        invalidate_inline_cache(row[0])
+    return row is not None
+
+
+async def initialize_user_templates(user_id: int):
+    # Default templates are registered in the background at startup
+    await DEFAULT_TEMPLATES_LOADED.wait()
+    if not await get_user_templates(user_id):
+        created_at = int(time.time())
+        await db.executemany(
+            "INSERT INTO templates (user_id, video_file_id, created_at) VALUES (?, ?, ?)",
+            [(user_id, file_id, created_at) for file_id in DEFAULT_TEMPLATE_FILE_IDS],
+        )
+        invalidate_inline_cache(user_id)
+
+
+class DefaultTemplate(NamedTuple):
+    path: str
+    sha256: str
+    size: int
+    mtime_ns: int
+    file_id: str
+
+
+async def _resolve_default_template(
+    bot: Bot, video_file: str, registry: dict, by_hash: dict, upload_slots: asyncio.Semaphore
+) -> Optional[str]:
+    stat = os.stat(video_file)
+    entry = registry.get(video_file)
+    if entry and entry.size == stat.st_size and entry.mtime_ns == stat.st_mtime_ns:
+        return entry.file_id
+
+    sha256 = await asyncio.to_thread(file_sha256, video_file)
+    known = by_hash.get(sha256)
+    if known:
+        # Touched or renamed, but the content was uploaded before
+        file_id = known.file_id
+    else:
+        async with upload_slots:
+            msg = await bot.send_video_note(
+                chat_id=CHANNEL_ID,
+                video_note=FSInputFile(video_file),
+                disable_notification=True,
+            )
+        if not msg.video_note:
+            logging.error(f"Failed to send video note for {video_file}")
+            return None
+        file_id = msg.video_note.file_id
+        logging.info(f"Uploaded template {video_file}")
+
+    await db.execute(
+        """INSERT OR REPLACE INTO default_templates (path, sha256, size, mtime_ns, file_id, updated_at)
+           VALUES (?, ?, ?, ?, ?, ?)""",
+        (video_file, sha256, stat.st_size, stat.st_mtime_ns, file_id, int(time.time())),
+    )
+    return file_id
+
+
+async def load_default_templates(bot: Bot):
+    try:
+        if not os.path.exists(VIDEOS_DIR):
+            os.makedirs(VIDEOS_DIR)
+        if not CHANNEL_ID:
+            logging.error("CHANNEL_ID is not set in environment.")
+            return
+
+        video_files = sorted(glob.glob(os.path.join(VIDEOS_DIR, "*.mp4")))
+        registry = {
+            entry.path: entry
+            for entry in await db.fetchall(
+                f"SELECT {', '.join(DefaultTemplate._fields)} FROM default_templates",
+                row_type=DefaultTemplate,
+            )
+        }
+        by_hash = {entry.sha256: entry for entry in registry.values()}
+        upload_slots = asyncio.Semaphore(TEMPLATE_UPLOAD_CONCURRENCY)
+
+        async def resolve(video_file):
+            try:
+                return await _resolve_default_template(bot, video_file, registry, by_hash, upload_slots)
+            except Exception as e:
+                logging.error(f"Error loading template {video_file}: {e}")
+                return None
+
+        file_ids = await asyncio.gather(*(resolve(video_file) for video_file in video_files))
+        DEFAULT_TEMPLATE_FILE_IDS[:] = [file_id for file_id in file_ids if file_id]
+
+        removed = [(path,) for path in registry if path not in video_files]
+        if removed:
+            await db.executemany("DELETE FROM default_templates WHERE path = ?", removed)
+        logging.info(f"Loaded {len(DEFAULT_TEMPLATE_FILE_IDS)} default templates")
+    finally:
+        DEFAULT_TEMPLATES_LOADED.set()
+
+
+# ----- FSM STORAGE -----
+@dataclass
+class _FSMRecord:
+    state: Optional[str]
+    data: dict
+    touched_at: float
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM storage persisted to SQLite behind an in-memory LRU cache.
+
+    Reads and writes hit the cache; changed records are written back in one
+    batched transaction every `flush_interval` seconds and on close. Records
+    idle for longer than `ttl` seconds are expired from memory and disk.
+    """
+
+    def __init__(self, database: Database, max_cached: int, ttl: int, flush_interval: float):
+        self.database = database
+        self.max_cached = max_cached
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self._cache = OrderedDict()  # key -> _FSMRecord
+        self._dirty = {}  # key -> _FSMRecord, including records evicted from the cache
+        self._flush_task = None
+
+    def start(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(
+            str(part) if part is not None else ""
+            for part in (
+                key.bot_id,
+                key.chat_id,
+                key.user_id,
+                key.thread_id,
+                getattr(key, "business_connection_id", None),
+                key.destiny,
+            )
+        )
+
+    async def _record(self, key: StorageKey) -> _FSMRecord:
+        record_key = self._key(key)
+        now = time.time()
+        record = self._cache.get(record_key) or self._dirty.get(record_key)
+        if record is None:
+            row = await self.database.fetchone(
+                "SELECT state, data FROM fsm_storage WHERE key = ? AND updated_at >= ?",
+                (record_key, int(now) - self.ttl),
+            )
+            # Another coroutine may have loaded the record while we waited
+            record = self._cache.get(record_key) or self._dirty.get(record_key)
+            if record is None:
+                record = _FSMRecord(row[0], json.loads(row[1]), now) if row else _FSMRecord(None, {}, now)
+        record.touched_at = now
+        self._cache[record_key] = record
+        self._cache.move_to_end(record_key)
+        while len(self._cache) > self.max_cached:
+            # Dirty records stay in _dirty until the next flush writes them
+            self._cache.popitem(last=False)
+        return record
+
+    def _mark_dirty(self, key: StorageKey, record: _FSMRecord):
+        self._dirty[self._key(key)] = record
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._record(key)
+        record.state = state.state if isinstance(state, State) else state
+        self._mark_dirty(key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._record(key)).state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        record = await self._record(key)
+        record.data = dict(data)
+        self._mark_dirty(key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict((await self._record(key)).data)
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        now = int(time.time())
+        upserts = []
+        deletes = []
+        for record_key, record in dirty.items():
+            if record.state is None and not record.data:
+                deletes.append((record_key,))
+            else:
+                upserts.append((record_key, record.state, json.dumps(record.data), now))
+
+        def write(conn):
+            if upserts:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO fsm_storage (key, state, data, updated_at) VALUES (?, ?, ?, ?)",
+                    upserts,
+                )
+            if deletes:
+                conn.executemany("DELETE FROM fsm_storage WHERE key = ?", deletes)
+
+        try:
+            await self.database.run(write)
+        except BaseException:
+            # Keep the records for the next attempt unless they changed since
+            for record_key, record in dirty.items():
+                self._dirty.setdefault(record_key, record)
+            raise
+
+    async def expire(self):
+        cutoff = time.time() - self.ttl
+        for record_key in [k for k, r in self._cache.items() if r.touched_at < cutoff]:
+            if record_key not in self._dirty:
+                del self._cache[record_key]
+        await self.database.execute(
+            "DELETE FROM fsm_storage WHERE updated_at < ?", (int(cutoff),)
+        )
+
+    async def _flush_loop(self):
+        last_expire = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.monotonic() - last_expire >= FSM_EXPIRE_INTERVAL:
+                    last_expire = time.monotonic()
+                    await self.expire()
+            except Exception as e:
+                logging.error(f"Error flushing FSM storage: {e}")
+
+    async def close(self) -> None:
+        if self._flush_task:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        await self.flush()
+
+
+# ----- CACHES -----
+class LRUCache:
+    """Least-recently-used cache bounded by item count and optionally by bytes."""
+
+    def __init__(self, max_items: int, max_bytes: Optional[int] = None, sizeof=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda value: 0)
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self._items = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __contains__(self, key) -> bool:
+        return key in self._items
+
+    def get(self, key, default=None):
+        try:
+            value, _ = self._items[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            # Never worth evicting everything for a single oversized entry
+            self.pop(key)
+            return
+        self.pop(key)
+        self._items[key] = (value, size)
+        self.bytes += size
+        while len(self._items) > self.max_items or (
+            self.max_bytes is not None and self.bytes > self.max_bytes
+        ):
+            _, (_, evicted_size) = self._items.popitem(last=False)
+            self.bytes -= evicted_size
+
+    def pop(self, key, default=None):
+        item = self._items.pop(key, None)
+        if item is None:
+            return default
+        self.bytes -= item[1]
+        return item[0]
+
+    def clear(self):
+        self._items.clear()
+        self.bytes = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "items": len(self._items),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key onto one running task."""
+
+    def __init__(self):
+        self._calls: Dict[Any, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    async def run(self, key, func, *args) -> tuple:
+        """Returns (result, shared); `shared` is False only for the call that ran `func`."""
+        call = self._calls.get(key)
+        if call is not None:
+            # Shielded so a waiter giving up doesn't cancel the job for everyone
+            return await asyncio.shield(call), True
+        call = asyncio.ensure_future(func(*args))
+        self._calls[key] = call
+        call.add_done_callback(lambda _: self._calls.pop(key, None))
+        return await asyncio.shield(call), False
+
+
+def font_footprint(font) -> int:
+    """Rough resident size of a loaded font: FreeType keeps the face in memory."""
+    path = getattr(font, "path", None)
+    if isinstance(path, str) and os.path.exists(path):
+        return os.path.getsize(path)
+    return 0
+
+
+# Font and overlay caches live in each render worker process
+_font_cache = LRUCache(FONT_CACHE_SIZE, max_bytes=FONT_CACHE_BYTES, sizeof=font_footprint)
+_layout_cache = LRUCache(FONT_CACHE_SIZE)
+_overlay_cache = LRUCache(
+    OVERLAY_CACHE_SIZE,
+    max_bytes=OVERLAY_CACHE_BYTES,
+    sizeof=lambda image: image.width * image.height * 4,
+)
+
+
+# Inline query results per user, dropped whenever their video notes or
+# templates change. The TTL bounds staleness across several bot replicas.
+_inline_cache = LRUCache(INLINE_CACHE_SIZE)
+
+
+def invalidate_inline_cache(user_id: int):
+    _inline_cache.pop(user_id)
+
+
+# ----- RENDER CACHE -----
+# Maps (source file_unique_id, canonical render spec) to the file_id of the
+# video note Telegram stored for it, so identical renders are sent by file_id.
+RENDER_CACHE_STATS = {"hits": 0, "misses": 0}
+
+
+def render_cache_key(source_unique_id: str, spec: "RenderSpec") -> Optional[str]:
+    if not source_unique_id or spec.audio_path or spec.overlay_path:
+        # Renders that depend on transient local files can't be addressed
+        return None
+    description = {"source": source_unique_id, "spec": asdict(spec)}
+    if spec.text:
+        description["font"] = [FONT_PATH, OVERLAY_STYLE]
+    canonical = json.dumps(description, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+async def get_cached_render(cache_key: Optional[str]) -> Optional[str]:
+    if not cache_key:
+        return None
+    now = int(time.time())
+
+    def lookup(conn):
+        row = conn.execute(
+            "SELECT video_note_file_id FROM render_cache WHERE cache_key = ? AND last_used_at >= ?",
+            (cache_key, now - RENDER_CACHE_TTL),
+        ).fetchone()
+        if row:
+            conn.execute(
+                "UPDATE render_cache SET last_used_at = ?, hits = hits + 1 WHERE cache_key = ?",
+                (now, cache_key),
+            )
+        return row
+
+    row = await db.run(lookup)
+    RENDER_CACHE_STATS["hits" if row else "misses"] += 1
+    return row[0] if row else None
+
+
+async def store_cached_render(cache_key: Optional[str], source_unique_id: str, video_note_file_id: str):
+    if not cache_key:
+        return
+    now = int(time.time())
+
+    def store(conn):
+        conn.execute(
+            """INSERT OR REPLACE INTO render_cache
+               (cache_key, source_unique_id, video_note_file_id, created_at, last_used_at, hits)
+               VALUES (?, ?, ?, ?, ?, 0)""",
+            (cache_key, source_unique_id, video_note_file_id, now, now),
+        )
+        # TTL eviction, then LRU eviction down to the row limit
         conn.execute(
-            """INSERT INTO video_notes (user_id, video_note_file_id, channel_message_id, uploaded_video_file_id, text, caption, effect, duration, width, height, created_at)
-               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-            (
-                user_id,
-                video_note_file_id,
-                channel_message_id,
-                uploaded_video_file_id,
-                text,
-                caption,
-                effect,
-                duration,
-                width,
-                height,
-                created_at,
-            ),
+            "DELETE FROM render_cache WHERE last_used_at < ?", (now - RENDER_CACHE_TTL,)
         )
-        conn.commit()
+        conn.execute(
+            """DELETE FROM render_cache WHERE cache_key IN (
+                SELECT cache_key FROM render_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+            )""",
+            (RENDER_CACHE_MAX_ROWS,),
+        )
+
+    await db.run(store)
+
+
+async def render_cache_stats() -> dict:
+    rows = (await db.fetchone("SELECT COUNT(*) FROM render_cache"))[0]
+    lookups = RENDER_CACHE_STATS["hits"] + RENDER_CACHE_STATS["misses"]
+    return {
+        **RENDER_CACHE_STATS,
+        "rows": rows,
+        "hit_rate": RENDER_CACHE_STATS["hits"] / lookups if lookups else 0.0,
+    }
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# ----- RENDER SERVICE -----
+class RenderQueueFull(Exception):
+    pass
+
+
+class RenderJob:
+    """Awaitable handle for a job queued on the render service."""
+
+    def __init__(self, user_id: int, func, args: tuple):
+        self.user_id = user_id
+        self.func = func
+        self.args = args
+        self.future = asyncio.get_running_loop().create_future()
+        self.queued_at = time.perf_counter()
+
+    def __await__(self):
+        return self.future.__await__()
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def cancel(self) -> bool:
+        return self.future.cancel()
+
+
+def _init_render_worker():
+    # Pay for the media stack once per worker instead of in the bot process
+    started = time.perf_counter()
+    import PIL.Image  # noqa: F401
+    import pilmoji  # noqa: F401
+
+    logging.info(
+        f"Render worker {os.getpid()} ready, imports took {time.perf_counter() - started:.2f}s"
+    )
+
+
+def worker_cache_stats() -> dict:
+    return {
+        "font": _font_cache.stats(),
+        "layout": _layout_cache.stats(),
+        "overlay": _overlay_cache.stats(),
+    }
+
+
+# Runs inside a render worker process
+def _run_render_job(func, *args) -> tuple:
+    """Runs `func` and reports this worker's cache counters with its result."""
+    return func(*args), os.getpid(), worker_cache_stats()
+
+
+class RenderService:
+    """Runs blocking render functions in a process pool.
+
+    Jobs wait in per-user queues which are drained round-robin, so one user
+    submitting several videos can't starve everybody else. The total number of
+    queued jobs and the number of queued jobs per user are both bounded.
+    """
+
+    def __init__(self, workers: int, max_queue: int, max_per_user: int):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_per_user = max_per_user
+        self._queues = OrderedDict()  # user_id -> deque[RenderJob]
+        self._pending = 0
+        self._in_flight = 0
+        self._wakeup = asyncio.Event()
+        self._executor = None
+        self._tasks = []
+        self._worker_stats = {}  # pid -> latest worker_cache_stats()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._pending
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def cache_stats(self) -> dict:
+        """Worker cache counters summed over all workers that reported so far."""
+        totals = {}
+        for stats in self._worker_stats.values():
+            for name, cache in stats.items():
+                total = totals.setdefault(name, {"items": 0, "bytes": 0, "hits": 0, "misses": 0})
+                for field in total:
+                    total[field] += cache[field]
+        return totals
+
+    async def start(self):
+        # Forking here would copy the event loop, SQLite connections and
+        # helper threads into the workers, so they start from a clean server
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("forkserver"),
+            initializer=_init_render_worker,
+        )
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+        logging.info(f"Render service started with {self.workers} workers")
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for user_jobs in self._queues.values():
+            for job in user_jobs:
+                job.cancel()
+        self._queues.clear()
+        self._pending = 0
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def submit(self, user_id: int, func, *args) -> RenderJob:
+        if self._executor is None:
+            raise RuntimeError("Render service is not started")
+        if self._pending >= self.max_queue:
+            raise RenderQueueFull("Render queue is full")
+        user_jobs = self._queues.get(user_id)
+        if user_jobs and len(user_jobs) >= self.max_per_user:
+            raise RenderQueueFull(f"User {user_id} has too many queued renders")
+        job = RenderJob(user_id, func, args)
+        if user_jobs is None:
+            self._queues[user_id] = user_jobs = deque()
+        user_jobs.append(job)
+        self._pending += 1
+        self._wakeup.set()
+        return job
+
+    def _next_job(self):
+        while self._queues:
+            # Take one job from the user at the head and move them to the back
+            user_id, user_jobs = self._queues.popitem(last=False)
+            job = user_jobs.popleft()
+            if user_jobs:
+                self._queues[user_id] = user_jobs
+            self._pending -= 1
+            if not job.done():
+                return job
+        return None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = self._next_job()
+            if job is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            self._in_flight += 1
+            started = time.perf_counter()
+            RENDER_WAIT_SECONDS.observe(started - job.queued_at)
+            try:
+                result, pid, stats = await loop.run_in_executor(
+                    self._executor, _run_render_job, job.func, *job.args
+                )
+                self._worker_stats[pid] = stats
+            except Exception as e:
+                if not job.done():
+                    job.future.set_exception(e)
+            else:
+                if not job.done():
+                    job.future.set_result(result)
+            finally:
+                self._in_flight -= 1
+                RENDER_SECONDS.labels(job.func.__name__).observe(time.perf_counter() - started)
+
+
+render_service = RenderService(RENDER_WORKERS, RENDER_QUEUE_SIZE, RENDER_USER_QUEUE_SIZE)
+
+
+# ----- RATE LIMITING -----
+class TokenBucket:
+    """Token bucket that hands out send slots in call order.
+
+    ``reserve`` always takes a token and returns how long the caller must wait
+    for it, so the bucket may go into debt and waiting callers form a FIFO queue.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self) -> float:
+        self._refill()
+        self._tokens -= 1
+        return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def pause(self, seconds: float):
+        """Hold back every slot for ``seconds``, e.g. after a flood-wait."""
+        self._refill()
+        self._tokens = min(self._tokens, -seconds * self.rate)
+
+
+async def wait_for_slot(bucket: TokenBucket):
+    delay = bucket.reserve()
+    if delay:
+        await asyncio.sleep(delay)
+
+
+# Calls that post a new message; deletes and edits don't count towards the limits
+MESSAGE_SEND_METHODS = {"copyMessage", "copyMessages", "forwardMessage", "forwardMessages"}
+
+
+def is_message_send(method) -> bool:
+    name = getattr(method, "__api_method__", "")
+    return name in MESSAGE_SEND_METHODS or (
+        name.startswith("send") and name != "sendChatAction"
+    )
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """Throttle outgoing messages to Telegram's flood limits.
+
+    A call first waits on its chat's bucket and only then on the global one, so
+    a single busy chat can't take more than its share of the global rate.
+    ``TelegramRetryAfter`` pauses the chat's bucket and the call is retried.
+    """
+
+    def __init__(self, max_retries: int = RATE_LIMIT_MAX_RETRIES):
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(RATE_LIMIT_GLOBAL, RATE_LIMIT_GLOBAL)
+        self.throttled = 0
+        self.retries = 0
+        self._chat_buckets = LRUCache(RATE_LIMIT_CHAT_BUCKETS)
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if CHANNEL_ID and str(chat_id) == str(CHANNEL_ID):
+                bucket = TokenBucket(RATE_LIMIT_CHANNEL, RATE_LIMIT_CHANNEL_BURST)
+            elif isinstance(chat_id, str) or chat_id < 0:
+                bucket = TokenBucket(RATE_LIMIT_GROUP, RATE_LIMIT_GROUP_BURST)
+            else:
+                bucket = TokenBucket(RATE_LIMIT_CHAT, RATE_LIMIT_CHAT_BURST)
+            self._chat_buckets.put(chat_id, bucket)
+        return bucket
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or not is_message_send(method):
+            return await make_request(bot, method)
+        bucket = self._chat_bucket(chat_id)
+        for attempt in range(self.max_retries + 1):
+            started = time.monotonic()
+            await wait_for_slot(bucket)
+            await wait_for_slot(self.global_bucket)
+            if time.monotonic() - started > 0.01:
+                self.throttled += 1
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                # Telegram's hint plus a growing margin in case it keeps refusing
+                delay = e.retry_after + attempt
+                self.retries += 1
+                logging.warning(
+                    f"Flood wait on {type(method).__name__} to {chat_id}: "
+                    f"retrying in {delay}s ({attempt + 1}/{self.max_retries})"
+                )
+                bucket.pause(delay)
+
+
+rate_limiter = RateLimitMiddleware()
+
+
+# ----- HELPER FUNCTIONS FOR FILE HANDLING -----
+async def download_telegram_file(bot: Bot, file_id: str, path: str) -> str:
+    file = await bot.get_file(file_id)
+    started = time.perf_counter()
+    try:
+        # With a path destination aiogram streams the body to disk chunk by chunk
+        await bot.download_file(
+            file.file_path,
+            destination=path,
+            timeout=DOWNLOAD_TIMEOUT,
+            chunk_size=DOWNLOAD_CHUNK_SIZE,
+        )
+    except BaseException:
+        cleanup_file(path)
+        raise
+    elapsed = time.perf_counter() - started
+    DOWNLOAD_SECONDS.labels("telegram").observe(elapsed)
+    size = os.path.getsize(path)
+    logging.info(
+        f"Downloaded {file_id}: {size} bytes in {elapsed:.2f}s "
+        f"({size / max(elapsed, 1e-6) / 1024 / 1024:.2f} MB/s)"
+    )
+    return path
+
+def cleanup_file(path: str):
+    if os.path.exists(path):
+        os.unlink(path)
+
+
+async def send_final(
+    bot: Bot, chat, video_note_file_id: str, caption: str, caption_up: bool,
+    effect_id: Optional[str],
+):
+    return await bot.send_video(
+        chat_id=chat,
+        video=video_note_file_id,
+        message_effect_id=effect_id,
+        caption=caption,
+        show_caption_above_media=caption_up,
+    )
+
+
+# ----- SCRATCH SPACE -----
+class ScratchSpaceFull(RenderQueueFull):
+    pass
+
+
+class ScratchJob:
+    """A private scratch directory, removed with everything in it on close."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._counter = 0
+
+    def file(self, suffix: str = "") -> str:
+        self._counter += 1
+        return os.path.join(self.path, f"{self._counter}{suffix}")
+
+    def close(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self) -> "ScratchJob":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ScratchSpace:
+    """Per-job directories for temporary media under one root.
+
+    Directories are prefixed with the owning pid and a per-run token, so
+    anything left behind by a crashed process is swept on the next start,
+    even when it comes back with the same pid as in a container.
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.prefix = f"{os.getpid()}.{os.urandom(4).hex()}"
+
+    def usage(self) -> int:
+        total = 0
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(directory, name))
+                except FileNotFoundError:
+                    pass
+        return total
+
+    def sweep(self) -> int:
+        """Removes job directories of processes that are no longer running."""
+        os.makedirs(self.root, exist_ok=True)
+        swept = 0
+        for name in os.listdir(self.root):
+            prefix = name.split("-", 1)[0]
+            pid = prefix.split(".", 1)[0]
+            if prefix == self.prefix:
+                continue
+            if pid.isdigit() and int(pid) != os.getpid() and _pid_alive(int(pid)):
+                continue
+            shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+            swept += 1
+        return swept
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.root, f"{self.prefix}-{name}")
+
+    async def job(self, name: Optional[str] = None) -> ScratchJob:
+        """Opens job directory `name`, reusing it if it exists, or a fresh one."""
+        # Walking the root is blocking I/O, kept off the event loop
+        if await asyncio.to_thread(self.usage) > self.max_bytes:
+            raise ScratchSpaceFull(f"Scratch space over {self.max_bytes} bytes")
+        path = self._path(name or os.urandom(6).hex())
+        os.makedirs(path, exist_ok=True)
+        return ScratchJob(path)
+
+    def discard(self, name: str):
+        shutil.rmtree(self._path(name), ignore_errors=True)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _scratch_root() -> str:
+    if SCRATCH_DIR:
+        return SCRATCH_DIR
+    # tmpfs keeps intermediate files off the disk, at the cost of RAM
+    if SCRATCH_TMPFS and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm/wiikotbot"
+    return os.path.join(tempfile.gettempdir(), "wiikotbot-scratch")
+
+
+scratch = ScratchSpace(_scratch_root(), SCRATCH_MAX_BYTES)
+
+
+# ----- MEDIA CACHE -----
+class _MediaEntry(NamedTuple):
+    path: str
+    size: int
+    touched_at: float
+
+
+class MediaCache:
+    """Local working copies of Telegram media keyed by file_unique_id, and of
+    link downloads keyed by content hash.
+
+    Copies stay while an edit session pins them, so repeated renders of the
+    same source never download it again. Unpinned copies are evicted LRU
+    first once the byte quota is exceeded, or when untouched for `ttl`.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, ttl: int, pin_ttl: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.pin_ttl = pin_ttl
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[str, _MediaEntry]" = OrderedDict()
+        self._pins: Dict[str, set] = {}
+        self._downloads = SingleFlight()
+
+    def load(self):
+        """Index copies left by a previous run, oldest first."""
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".part"):
+                # Interrupted download
+                cleanup_file(path)
+                continue
+            stat = os.stat(path)
+            found.append((stat.st_mtime, name, path, stat.st_size))
+        for mtime, name, path, size in sorted(found):
+            self._entries[name] = _MediaEntry(path, size, mtime)
+            self.bytes += size
+        self.evict()
+
+    def _name(self, unique_id: str) -> str:
+        return re.sub(r"[^\w-]", "_", unique_id)
+
+    async def fetch(self, bot: Bot, file_id: str, unique_id: str) -> str:
+        name = self._name(unique_id)
+        entry = self._entries.get(name)
+        if entry and os.path.exists(entry.path):
+            self.hits += 1
+            self._entries[name] = entry._replace(touched_at=time.time())
+            self._entries.move_to_end(name)
+            return entry.path
+        self.misses += 1
+        self.evict()
+        path, _ = await self._downloads.run(name, self._download, bot, file_id, name)
+        return path
+
+    async def _download(self, bot: Bot, file_id: str, name: str) -> str:
+        path = os.path.join(self.directory, name)
+        # Downloaded next to its final name so readers never see a partial file
+        os.replace(await download_telegram_file(bot, file_id, f"{path}.part"), path)
+        self._index(name, path)
+        return path
+
+    async def add(self, unique_id: str, local_path: str) -> str:
+        """Moves a local file into the cache and returns its new path."""
+        name = self._name(unique_id)
+        entry = self._entries.get(name)
+        if entry and os.path.exists(entry.path):
+            cleanup_file(local_path)
+            self._entries[name] = entry._replace(touched_at=time.time())
+            self._entries.move_to_end(name)
+            return entry.path
+        path = os.path.join(self.directory, name)
+        # The scratch root may be on another filesystem, such as tmpfs
+        await asyncio.to_thread(shutil.move, local_path, f"{path}.part")
+        os.replace(f"{path}.part", path)
+        self._index(name, path)
+        return path
+
+    def _index(self, name: str, path: str):
+        old = self._entries.pop(name, None)
+        if old:
+            self.bytes -= old.size
+        size = os.path.getsize(path)
+        self._entries[name] = _MediaEntry(path, size, time.time())
+        self.bytes += size
+        self.evict()
+
+    def pin(self, unique_id: str, owner):
+        self._pins.setdefault(self._name(unique_id), set()).add(owner)
+
+    def unpin(self, unique_id: str, owner):
+        name = self._name(unique_id)
+        owners = self._pins.get(name)
+        if owners is not None:
+            owners.discard(owner)
+            if not owners:
+                del self._pins[name]
+
+    @contextmanager
+    def pinned(self, unique_id: str):
+        owner = object()
+        self.pin(unique_id, owner)
+        try:
+            yield
+        finally:
+            self.unpin(unique_id, owner)
+
+    def evict(self):
+        now = time.time()
+        for name, entry in list(self._entries.items()):
+            # Sessions abandoned without Apply or Cancel never unpin
+            ttl = self.pin_ttl if name in self._pins else self.ttl
+            if now - entry.touched_at > ttl or (
+                self.bytes > self.max_bytes and name not in self._pins
+            ):
+                self._drop(name)
+
+    def _drop(self, name: str):
+        entry = self._entries.pop(name)
+        self._pins.pop(name, None)
+        self.bytes -= entry.size
+        self.evictions += 1
+        cleanup_file(entry.path)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "items": len(self._entries),
+            "pinned": len(self._pins),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+media_cache = MediaCache(MEDIA_CACHE_DIR, MEDIA_CACHE_BYTES, MEDIA_CACHE_TTL, MEDIA_CACHE_PIN_TTL)
+
+
+# ----- HTTP CLIENT -----
+class DownloadError(Exception):
+    pass
+
+
+class HttpClient:
+    """One pooled aiohttp session per process for Cobalt and media downloads."""
+
+    def __init__(self):
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # Created lazily so it binds to the running event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=HTTP_POOL_SIZE,
+                limit_per_host=HTTP_POOL_PER_HOST,
+                ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+                keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(
+                    total=None,
+                    connect=HTTP_CONNECT_TIMEOUT,
+                    sock_read=HTTP_READ_TIMEOUT,
+                ),
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+http_client = HttpClient()
+
 
+async def resolve_cobalt_url(url: str) -> str:
+    payload = {"url": url, "videoQuality": "720"}
+    headers = {"Accept": "application/json"}
+    async with http_client.session.post(COBALT_API_URL, json=payload, headers=headers) as response:
+        if response.status != 200:
+            raise DownloadError(f"Cobalt API Error {response.status}")
+        data = await response.json()
+    if data.get("status") not in ("stream", "redirect", "tunnel"):
+        raise DownloadError(f"Cobalt status: {data.get('status')}")
+    if not data.get("url"):
+        raise DownloadError("Cobalt did not return URL")
+    return data["url"]
 
-def get_user_videos(user_id: int, limit: int = 10):
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.execute(
-            """SELECT id, video_note_file_id, channel_message_id, uploaded_video_file_id,
-            text, caption, duration, width, height, created_at
-            FROM video_notes WHERE user_id = ?
-            ORDER BY created_at DESC LIMIT ?""",
-            (user_id, limit),
-        )
-        rows = cursor.fetchall()
-    return [
-        {
-            "id": row[0],
-            "video_note_file_id": row[1],
-            "channel_message_id": row[2],
-            "uploaded_video_file_id": row[3],
-            "text": row[4],
-            "caption": row[5],
-            "duration": row[6],
-            "width": row[7],
-            "height": row[8],
-            "created_at": row[9],
-        }
-        for row in rows
-    ]
+
+async def fetch_range(url: str, path: str, start: int, end: Optional[int] = None) -> int:
+    """Write bytes ``start``..``end`` (inclusive, or to EOF) of ``url`` into ``path``
+    at the same offset. Dropped connections resume from the last written byte."""
+    position = start
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        headers = {"Range": f"bytes={position}-{'' if end is None else end}"}
+        try:
+            async with http_client.session.get(url, headers=headers) as response:
+                if response.status == 200:
+                    if start:
+                        raise DownloadError("Server ignored the range request")
+                    # No range support: the whole body comes again from byte 0
+                    position = 0
+                elif response.status != 206:
+                    raise DownloadError(f"Download failed: {response.status}")
+                with open(path, "r+b") as f:
+                    f.seek(position)
+                    async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                        position += len(chunk)
+                    if response.status == 200:
+                        f.truncate()
+                        return position
+            if end is None or position > end:
+                return position - start
+            logging.warning(f"Short read of {url} at byte {position}, resuming")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == DOWNLOAD_RETRIES:
+                raise
+            logging.warning(f"Download of {url} broke at byte {position}: {e}, resuming")
+        await asyncio.sleep(min(2 ** attempt, 10))
+    raise DownloadError(f"Could not download {url} after {DOWNLOAD_RETRIES} retries")
+
+
+async def content_length(url: str) -> Optional[int]:
+    """Size of ``url`` if the server supports byte ranges, otherwise None."""
+    try:
+        async with http_client.session.head(url, allow_redirects=True) as response:
+            if response.status == 200 and response.headers.get("Accept-Ranges") == "bytes":
+                return response.content_length
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.info(f"HEAD {url} failed, downloading in one stream: {e}")
+    return None
 
 
-def get_video_by_id(video_id: int):
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.execute(
-            """SELECT id, video_note_file_id, channel_message_id, uploaded_video_file_id,
-            text, caption, duration, width, height, created_at
-            FROM video_notes WHERE id = ?""",
-            (video_id,),
+async def download_http_file(url: str, path: str) -> int:
+    size = await content_length(url)
+    with open(path, "wb") as f:
+        if size:
+            f.truncate(size)
+    if not size or size < 2 * DOWNLOAD_PART_SIZE or DOWNLOAD_PARALLEL_PARTS < 2:
+        return await fetch_range(url, path, 0, size - 1 if size else None)
+    parts = min(DOWNLOAD_PARALLEL_PARTS, -(-size // DOWNLOAD_PART_SIZE))
+    part_size = -(-size // parts)
+    written = await asyncio.gather(
+        *(
+            fetch_range(url, path, start, min(start + part_size, size) - 1)
+            for start in range(0, size, part_size)
         )
-        row = cursor.fetchone()
-    if row:
-        return {
-            "id": row[0],
-            "video_note_file_id": row[1],
-            "channel_message_id": row[2],
-            "uploaded_video_file_id": row[3],
-            "text": row[4],
-            "caption": row[5],
-            "duration": row[6],
-            "width": row[7],
-            "height": row[8],
-            "created_at": row[9],
-        }
-    return None
+    )
+    return sum(written)
+
+
+async def download_url_video(url: str, path: str) -> str:
+    video_url = await resolve_cobalt_url(url)
+    started = time.perf_counter()
+    size = await download_http_file(video_url, path)
+    elapsed = time.perf_counter() - started
+    DOWNLOAD_SECONDS.labels("url").observe(elapsed)
+    logging.info(
+        f"Downloaded {url}: {size} bytes in {elapsed:.2f}s "
+        f"({size / max(elapsed, 1e-6) / 1024 / 1024:.2f} MB/s)"
+    )
+    return path
+
+
+# ----- RENDER ENGINE -----
+class RenderError(Exception):
+    pass
+
+
+@dataclass
+class RenderSpec:
+    """Declarative description of a single ffmpeg render."""
+
+    start: float = 0
+    duration: Optional[float] = None  # Trim to at most this many seconds
+    crop_square: bool = True  # Center crop to a square
+    size: Optional[int] = VIDEO_NOTE_SIZE  # Output side in pixels
+    text: Optional[str] = None  # Rasterized to an overlay PNG by the worker
+    overlay_path: Optional[str] = None  # Pre-rendered RGBA overlay PNG
+    audio: str = "aac"  # "aac", "copy" or "none"
+    audio_path: Optional[str] = None  # Replace the audio track with this file
+    preset: str = "veryfast"
+    crf: int = 23
+    audio_bitrate: str = "128k"
+
+
+class EncoderProfile(NamedTuple):
+    preset: str
+    crf: int
+    size: int
+    audio_bitrate: str
+
+
+def load_encoder_profile(name: str, default: EncoderProfile) -> EncoderProfile:
+    """Profile `name` with each field overridable by e.g. PREVIEW_CRF."""
+    prefix = name.upper()
+    return EncoderProfile(
+        preset=os.getenv(f"{prefix}_PRESET", default.preset),
+        crf=int(os.getenv(f"{prefix}_CRF", str(default.crf))),
+        size=int(os.getenv(f"{prefix}_SIZE", str(default.size))),
+        audio_bitrate=os.getenv(f"{prefix}_AUDIO_BITRATE", default.audio_bitrate),
+    )
 
 
-def delete_video(video_id: int):
-    with sqlite3.connect(DATABASE) as conn:
-        conn.execute("DELETE FROM video_notes WHERE id = ?", (video_id,))
-        conn.commit()
+# Previews only need to be watchable; CPU goes to what ends up in the channel
+ENCODER_PROFILES = {
+    "preview": load_encoder_profile("preview", EncoderProfile("ultrafast", 30, 384, "64k")),
+    "final": load_encoder_profile("final", EncoderProfile("medium", 20, VIDEO_NOTE_SIZE, "128k")),
+}
 
 
-# ----- TEMPLATE FUNCTIONS -----
-def add_template(user_id: int, video_file_id: str):
-    created_at = datetime.now().strftime("%d.%m.%Y %H:%M:%S")
-    with sqlite3.connect(DATABASE) as conn:
-        conn.execute(
-            "INSERT INTO templates (user_id, video_file_id, created_at) VALUES (?, ?, ?)",
-            (user_id, video_file_id, created_at),
+def build_ffmpeg_args(spec: RenderSpec, input_path: str, output_path: str) -> list:
+    args = [FFMPEG_BIN, "-hide_banner", "-loglevel", "error", "-nostdin", "-y"]
+    if spec.start:
+        args += ["-ss", f"{spec.start:.3f}"]
+    args += ["-i", input_path]
+    overlay_index = audio_index = None
+    next_index = 1
+    if spec.overlay_path:
+        args += ["-i", spec.overlay_path]
+        overlay_index, next_index = next_index, next_index + 1
+    if spec.audio_path:
+        args += ["-i", spec.audio_path]
+        audio_index = next_index
+
+    video_filters = []
+    if spec.crop_square:
+        # Crop defaults to the center of the frame
+        side = "'trunc(min(iw,ih)/2)*2'"
+        video_filters.append(f"crop={side}:{side}")
+    if spec.size:
+        video_filters.append(f"scale={spec.size}:{spec.size}")
+    video_filters.append("setsar=1")
+    if overlay_index is None:
+        video_filters.append("format=yuv420p")
+        graph = f"[0:v]{','.join(video_filters)}[v]"
+    else:
+        graph = (
+            f"[0:v]{','.join(video_filters)}[base];"
+            f"[base][{overlay_index}:v]overlay=(W-w)/2:(H-h)/2,format=yuv420p[v]"
         )
-        conn.commit()
+    args += ["-filter_complex", graph, "-map", "[v]"]
 
+    if spec.audio == "none":
+        args += ["-an"]
+    else:
+        source = audio_index if audio_index is not None else 0
+        args += ["-map", f"{source}:a:0?"]
+        if spec.audio == "copy" and audio_index is None:
+            args += ["-c:a", "copy"]
+        else:
+            args += ["-c:a", "aac", "-b:a", spec.audio_bitrate]
 
-def get_user_templates(user_id: int):
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.execute(
-            "SELECT id, video_file_id, created_at FROM templates WHERE user_id = ? ORDER BY created_at DESC",
-            (user_id,),
-        )
-        rows = cursor.fetchall()
-    return [
-        {"id": row[0], "video_file_id": row[1], "created_at": row[2]} for row in rows
+    args += [
+        "-c:v", "libx264",
+        "-preset", spec.preset,
+        "-crf", str(spec.crf),
+        "-movflags", "+faststart",
     ]
+    if spec.duration:
+        args += ["-t", f"{spec.duration:.3f}"]
+    if spec.audio_path:
+        args += ["-shortest"]
+    args.append(output_path)
+    return args
+
+
+def run_ffmpeg(args: list):
+    result = subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        stderr = result.stderr.decode(errors="replace").strip()
+        raise RenderError(f"ffmpeg exited with {result.returncode}: {stderr[-500:]}")
+
+
+class MediaInfo(NamedTuple):
+    duration: float
+    format_name: str
+    video_codec: Optional[str]
+    width: int
+    height: int
+    pix_fmt: Optional[str]
+    audio_codec: Optional[str]
+
+
+def probe_media(path: str) -> MediaInfo:
+    """Container and stream metadata read from the headers only."""
+    result = subprocess.run(
+        [
+            FFPROBE_BIN, "-v", "error",
+            "-show_entries", "format=duration,format_name:stream=codec_type,codec_name,width,height,pix_fmt",
+            "-of", "json",
+            path,
+        ],
+        capture_output=True,
+    )
+    if result.returncode != 0:
+        raise RenderError(f"ffprobe failed for {path}")
+    data = json.loads(result.stdout or b"{}")
+    streams = data.get("streams", [])
+    video = next((s for s in streams if s.get("codec_type") == "video"), {})
+    audio = next((s for s in streams if s.get("codec_type") == "audio"), {})
+    container = data.get("format", {})
+    return MediaInfo(
+        duration=float(container.get("duration") or 0),
+        format_name=container.get("format_name", ""),
+        video_codec=video.get("codec_name"),
+        width=int(video.get("width") or 0),
+        height=int(video.get("height") or 0),
+        pix_fmt=video.get("pix_fmt"),
+        audio_codec=audio.get("codec_name"),
+    )
 
 
-def delete_template_db(template_id: int):
-    with sqlite3.connect(DATABASE) as conn:
-        conn.execute("DELETE FROM templates WHERE id = ?", (template_id,))
-        conn.commit()
+def probe_duration(path: str) -> float:
+    return probe_media(path).duration
+
+
+def plan_render(spec: RenderSpec, info: MediaInfo) -> str:
+    """How much work `spec` needs on this input: "none", "copy" or "encode".
+
+    Inputs that already satisfy video note constraints are passed through or
+    trimmed by stream copy, which cuts at the keyframe before `spec.start`.
+    """
+    if spec.text or spec.overlay_path or spec.audio_path:
+        return "encode"
+    if info.video_codec != "h264" or info.pix_fmt != "yuv420p" or "mp4" not in info.format_name:
+        return "encode"
+    if info.audio_codec not in (None, "aac") or (spec.audio == "none" and info.audio_codec):
+        return "encode"
+    if spec.crop_square and info.width != info.height:
+        return "encode"
+    # Any side up to VIDEO_NOTE_SIZE is a valid note, and passing it through
+    # is cheaper than downscaling it for a preview
+    if info.width > max(spec.size or 0, VIDEO_NOTE_SIZE):
+        return "encode"
+    if spec.start or (spec.duration and info.duration > spec.duration):
+        return "copy"
+    return "none"
+
+
+def build_copy_args(spec: RenderSpec, input_path: str, output_path: str) -> list:
+    args = [FFMPEG_BIN, "-hide_banner", "-loglevel", "error", "-nostdin", "-y"]
+    if spec.start:
+        args += ["-ss", f"{spec.start:.3f}"]
+    args += ["-i", input_path, "-map", "0:v:0", "-map", "0:a:0?", "-c", "copy"]
+    if spec.duration:
+        args += ["-t", f"{spec.duration:.3f}"]
+    args += ["-avoid_negative_ts", "make_zero", "-movflags", "+faststart", output_path]
+    return args
+
+
+# ----- TEXT LAYOUT -----
+# Emoji are drawn by Pilmoji as images one font-size wide, so each cluster
+# (flags, keycaps, ZWJ sequences, skin tones) is measured as a single glyph.
+_EMOJI_CHAR = "[\u00a9\u00ae\u203c\u2049\u2122\u2139\u2194-\u21aa\u231a-\u23ff\u24c2\u25aa-\u27bf\u2934\u2935\u2b05-\u2b55\u3030\u303d\u3297\u3299\U0001F000-\U0001FAFF]"
+_EMOJI_MODIFIERS = "[\ufe0f\U0001F3FB-\U0001F3FF]*"
+EMOJI_CLUSTER_RE = re.compile(
+    "[\U0001F1E6-\U0001F1FF]{2}"
+    "|[0-9#*]\ufe0f?\u20e3"
+    f"|{_EMOJI_CHAR}{_EMOJI_MODIFIERS}(?:\u200d{_EMOJI_CHAR}{_EMOJI_MODIFIERS})*"
+)
 
 
-def initialize_user_templates(user_id: int):
-    if not get_user_templates(user_id):
-        for file_id in DEFAULT_TEMPLATE_FILE_IDS:
-            add_template(user_id, file_id)
+class TextLine(NamedTuple):
+    text: str
+    x: int
+    y: int
+    width: int
 
 
-async def load_default_templates(bot: Bot):
-    global DEFAULT_TEMPLATE_FILE_IDS
-    if not os.path.exists(VIDEOS_DIR):
-        os.makedirs(VIDEOS_DIR)
-    if not CHANNEL_ID:
-        logging.error("CHANNEL_ID is not set in environment.")
-        return
+class TextBlock(NamedTuple):
+    lines: list
+    width: int
+    height: int
+
+
+class TextLayout:
+    """Word wrapping for one font with cached per-word advances."""
+
+    def __init__(self, font):
+        self.font = font
+        self.emoji_width = getattr(font, "size", 10)
+        self._advances = LRUCache(TEXT_LAYOUT_CACHE_SIZE)
+        self.space_width = self._text_width(" ")
 
-    video_files = glob.glob(os.path.join(VIDEOS_DIR, "*.mp4"))
-    for video_file in video_files:
+    def _text_width(self, text: str) -> int:
         try:
-            with open(video_file, "rb") as f:
-                msg = await bot.send_video_note(
-                    chat_id=CHANNEL_ID,
-                    video_note=FSInputFile(video_file),
-                    disable_notification=True,
-                )
-                if msg.video_note:
-                    DEFAULT_TEMPLATE_FILE_IDS.append(msg.video_note.file_id)
-                    logging.info(f"Loaded template {video_file}")
-                else:
-                    logging.error(f"Failed to send video note for {video_file}")
+            return int(self.font.getlength(text))
+        except AttributeError:
+            left, _, right, _ = self.font.getbbox(text)
+            return right - left
+
+    def word_width(self, word: str) -> int:
+        width = self._advances.get(word)
+        if width is None:
+            width = 0
+            position = 0
+            for match in EMOJI_CLUSTER_RE.finditer(word):
+                if match.start() > position:
+                    width += self._text_width(word[position:match.start()])
+                width += self.emoji_width
+                position = match.end()
+            if position < len(word):
+                width += self._text_width(word[position:])
+            self._advances.put(word, width)
+        return width
+
+    def wrap(self, text: str, max_width: int) -> list:
+        """Greedily wraps `text` into (line, width) pairs no wider than `max_width`.
+
+        A single word wider than `max_width` gets a line of its own.
+        """
+        lines = []
+        words = []
+        line_width = 0
+        for word in text.split():
+            width = self.word_width(word)
+            if words and line_width + self.space_width + width > max_width:
+                lines.append((" ".join(words), line_width))
+                words = [word]
+                line_width = width
+            else:
+                line_width += width + (self.space_width if words else 0)
+                words.append(word)
+        if words:
+            lines.append((" ".join(words), line_width))
+        return lines
+
+    def layout(self, text: str, max_width: int, line_height: int) -> TextBlock:
+        """Wraps `text` and centers every line in a `max_width` wide block."""
+        lines = [
+            TextLine(line, max((max_width - width) // 2, 0), index * line_height, width)
+            for index, (line, width) in enumerate(self.wrap(text, max_width))
+        ]
+        return TextBlock(lines, max_width, max(len(lines), 1) * line_height)
+
+
+def load_font(font_path: str, fontsize: int):
+    key = (font_path, fontsize)
+    font = _font_cache.get(key)
+    if font is None:
+        from PIL import ImageFont
+
+        try:
+            font = ImageFont.truetype(font_path, fontsize)
         except Exception as e:
-            logging.error(f"Error loading template {video_file}: {e}")
+            logging.warning(f"Could not load custom font: {e}. Using default font.")
+            font = ImageFont.load_default()
+        _font_cache.put(key, font)
+    return font
 
 
-# ----- HELPER FUNCTIONS FOR FILE HANDLING -----
-async def download_temp_file(bot: Bot, file_id: str, suffix=".mp4") -> str:
-    file = await bot.get_file(file_id)
-    file_data = await bot.download_file(file.file_path)
-    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
-    tmp.write(file_data.read())
-    tmp.close()
-    return tmp.name
+def get_text_layout(font_path: str, fontsize: int) -> TextLayout:
+    key = (font_path, fontsize)
+    layout = _layout_cache.get(key)
+    if layout is None:
+        layout = TextLayout(load_font(font_path, fontsize))
+        _layout_cache.put(key, layout)
+    return layout
 
-def cleanup_file(path: str):
-    if os.path.exists(path):
-        os.unlink(path)
 
+def get_text_overlay(text: str, size: int):
+    """Returns the RGBA overlay image for `text` on a `size`-pixel square video."""
+    fontsize = size // 16
+    key = (text, size, FONT_PATH, fontsize, OVERLAY_STYLE)
+    text_img = _overlay_cache.get(key)
+    if text_img is not None:
+        return text_img
 
-async def send_final(
-    bot: Bot, chat, video_note_file_id: str, caption: str, caption_up: bool, effect_id: int
-):
-    return await bot.send_video(
-        chat_id=chat,
-        video=video_note_file_id,
-        message_effect_id=effect_id,
-        caption=caption,
-        show_caption_above_media=caption_up,
+    style = dict(OVERLAY_STYLE)
+    line_spacing = style.pop("line_spacing")
+    layout = get_text_layout(FONT_PATH, fontsize)
+    block = layout.layout(text, int(size * 0.8), fontsize + line_spacing)
+
+    from PIL import Image
+    from pilmoji import Pilmoji
+
+    text_img = Image.new("RGBA", (block.width, block.height), (0, 0, 0, 0))
+    with Pilmoji(text_img) as pilmoji:
+        for line in block.lines:
+            pilmoji.text((line.x, line.y), line.text, font=layout.font, **style)
+    _overlay_cache.put(key, text_img)
+    return text_img
+
+
+def render_text_overlay(text: str, size: int, output_path: str) -> str:
+    get_text_overlay(text, size).save(output_path, format="PNG")
+    return output_path
+
+
+# Runs inside a render worker process
+def render_video(input_path: str, output_path: str, spec: RenderSpec) -> str:
+    overlay_path = None
+    if spec.text and not spec.overlay_path:
+        overlay_path = render_text_overlay(
+            spec.text, spec.size or VIDEO_NOTE_SIZE, f"{output_path}.overlay.png"
+        )
+        spec = replace(spec, overlay_path=overlay_path)
+    try:
+        plan = plan_render(spec, probe_media(input_path))
+        if plan == "none":
+            try:
+                # A second name for the same inode, so the job owns what it returns
+                os.link(input_path, output_path)
+            except OSError:
+                # Scratch space and source on different filesystems, as with
+                # SCRATCH_TMPFS. A copy, since the source may be evicted once
+                # the render's pin is released.
+                shutil.copyfile(input_path, output_path)
+        elif plan == "copy":
+            run_ffmpeg(build_copy_args(spec, input_path, output_path))
+        else:
+            run_ffmpeg(build_ffmpeg_args(spec, input_path, output_path))
+        logging.info(f"Rendered {os.path.basename(input_path)} with plan {plan!r}")
+    finally:
+        if overlay_path:
+            cleanup_file(overlay_path)
+    return output_path
+
+
+# Runs inside a render worker process
+def extract_frame(input_path: str, output_path: str, position: float, size: int) -> str:
+    side = "'trunc(min(iw,ih)/2)*2'"
+    run_ffmpeg([
+        FFMPEG_BIN, "-hide_banner", "-loglevel", "error", "-nostdin", "-y",
+        "-ss", f"{position:.3f}", "-i", input_path, "-frames:v", "1",
+        "-vf", f"crop={side}:{side},scale={size}:{size}", output_path,
+    ])
+    return output_path
+
+
+# Runs inside a render worker process
+def render_text_still(frame_path: str, output_path: str, text: str) -> str:
+    """Composites `text` onto a square frame exactly where render_video puts it."""
+    from PIL import Image
+
+    with Image.open(frame_path) as frame:
+        frame = frame.convert("RGBA")
+    overlay = get_text_overlay(text, frame.width)
+    frame.alpha_composite(
+        overlay, ((frame.width - overlay.width) // 2, (frame.height - overlay.height) // 2)
     )
+    frame.convert("RGB").save(output_path, format="JPEG", quality=85)
+    return output_path
+
+
+# ----- EDIT SESSION -----
+# An edit session keeps the original input in FSM data as `source`
+# ({"file_id", "unique_id"} for Telegram media or {"path"} for downloads)
+# plus a list of pending `transforms` such as {"op": "trim", "duration": 60}.
+# Nothing is baked into the source, so Apply renders everything in one encode.
+def get_session_transform(transforms: list, op: str) -> Optional[dict]:
+    for transform in transforms:
+        if transform["op"] == op:
+            return transform
+    return None
+
 
+def set_session_transform(transforms: list, op: str, **params) -> list:
+    transforms = [t for t in transforms if t["op"] != op]
+    transforms.append({"op": op, **params})
+    return transforms
 
-async def process_video_file_trim(
-    bot: Bot, file_id: str, trim_duration: int = 60
+
+def build_render_spec(transforms: list, profile: str = "final") -> RenderSpec:
+    spec = RenderSpec(crop_square=False, **ENCODER_PROFILES[profile]._asdict())
+    for transform in transforms:
+        op = transform["op"]
+        if op == "crop":
+            spec.crop_square = True
+        elif op == "trim":
+            spec.start = transform.get("start", 0)
+            spec.duration = transform["duration"]
+        elif op == "text":
+            spec.text = transform["text"]
+        else:
+            raise ValueError(f"Unknown transform: {op}")
+    return spec
+
+
+async def render_source(
+    bot: Bot, source: dict, spec: RenderSpec, job: ScratchJob, user_id: int = 0
 ) -> str:
-    input_path = await download_temp_file(bot, file_id)
-    temp_output = tempfile.NamedTemporaryFile(delete=False, suffix=".mp4")
-    temp_output.close()
-    clip = VideoFileClip(input_path)
-    # Trim the clip if longer than trim_duration
-    if clip.duration > trim_duration:
-        clip = clip.subclip(0, trim_duration)
-    width, height = clip.size
-    # Crop to a square (center crop)
-    if width > height:
-        x = int((width - height) / 2)
-        y = 0
-        size = height
-    else:
-        x = 0
-        y = int((height - width) / 2)
-        size = width
-    cropped = clip.crop(x1=x, y1=y, x2=x + size, y2=y + size)
-    cropped.write_videofile(
-        temp_output.name, codec="libx264", audio_codec="aac", verbose=False, logger=None
-    )
-    clip.close()
-    cropped.close()
-    cleanup_file(input_path)
-    return temp_output.name
-
-
-async def process_video_file(bot: Bot, file_id: str) -> str:
-    input_path = await download_temp_file(bot, file_id)
-    temp_output = tempfile.NamedTemporaryFile(delete=False, suffix=".mp4")
-    temp_output.close()
-    clip = VideoFileClip(input_path)
-    width, height = clip.size
-    if width > height:
-        x = int((width - height) / 2)
-        y = 0
-        size = height
-    else:
-        x = 0
-        y = int((height - width) / 2)
-        size = width
-    cropped = clip.crop(x1=x, y1=y, x2=x + size, y2=y + size)
-    cropped.write_videofile(
-        temp_output.name, codec="libx264", audio_codec="aac", verbose=False, logger=None
-    )
-    clip.close()
-    cropped.close()
-    cleanup_file(input_path)
-    return temp_output.name
-
-
-async def add_text_to_video_file(bot: Bot, file_id: str, text: str) -> str:
-    input_path = await download_temp_file(bot, file_id)
-    temp_output = tempfile.NamedTemporaryFile(delete=False, suffix=".mp4")
-    temp_output.close()
-    clip = VideoFileClip(input_path)
-    width, height = clip.size
-    size = min(width, height)
-    if width != height:
-        x = int((width - size) / 2)
-        y = int((height - size) / 2)
-        clip = clip.crop(x1=x, y1=y, x2=x + size, y2=y + size)
+    with media_cache.pinned(source["unique_id"]):
+        input_path = await source_path(bot, source)
+        return await render_service.submit(
+            user_id, render_video, input_path, job.file(".mp4"), spec
+        )
 
-    fontsize = size // 16
-    font_path = "./SF-Pro.ttf"
+
+async def source_path(bot: Bot, source: dict) -> str:
+    """Local path of a session source, downloading Telegram media at most once."""
+    if source.get("path"):
+        return source["path"]
+    return await media_cache.fetch(bot, source["file_id"], source["unique_id"])
+
+
+async def get_or_render(
+    bot: Bot, source: dict, spec: RenderSpec, job: ScratchJob, user_id: int = 0
+) -> tuple:
+    """Returns (video, rendered_path, cache_key) for `spec` applied to `source`.
+
+    `video` is a cached video note file_id when this render was done before,
+    otherwise an FSInputFile of a fresh render at `rendered_path`.
+    """
+    cache_key = render_cache_key(source.get("unique_id"), spec)
+    cached_file_id = await get_cached_render(cache_key)
+    if cached_file_id:
+        return cached_file_id, None, cache_key
+    rendered_path = await render_source(bot, source, spec, job, user_id=user_id)
+    return FSInputFile(rendered_path), rendered_path, cache_key
+
+
+async def get_preview_frame(bot: Bot, data: dict, user_id: int) -> str:
+    """Path of a square still from the session's source, extracted once per session."""
+    frame_path = data.get("preview_frame")
+    if frame_path and os.path.exists(frame_path):
+        return frame_path
+    video = await get_video_by_id(data["edit_video_id"])
+    trim = get_session_transform(data.get("transforms", []), "trim") or {}
+    position = trim.get("start", 0) + (video.duration or 0) / 2
+    source = data["source"]
+    # Lives in the session's scratch directory until Apply or Cancel
+    frame_path = (await scratch.job(f"session-{data['edit_video_id']}")).file(".png")
+    with media_cache.pinned(source["unique_id"]):
+        input_path = await source_path(bot, source)
+        return await render_service.submit(
+            user_id, extract_frame, input_path, frame_path, position, VIDEO_NOTE_SIZE
+        )
+
+
+def release_session_source(data: dict):
+    source = data.get("source") or {}
+    if source.get("path"):
+        cleanup_file(source["path"])
+    elif source and data.get("edit_video_id"):
+        media_cache.unpin(source["unique_id"], data["edit_video_id"])
+    if data.get("edit_video_id"):
+        scratch.discard(f"session-{data['edit_video_id']}")
+
+
+async def discard_draft(bot: Bot, data: dict):
+    """Drop the row and channel post of a video that was never applied."""
+    if not data.get("draft_preview"):
+        return
     try:
-        font = ImageFont.truetype(font_path, fontsize)
+        await bot.delete_message(CHANNEL_ID, data["current_channel_msg_id"])
     except Exception as e:
-        logging.warning(f"Could not load custom font: {e}. Using default font.")
-        font = ImageFont.load_default()
-
-    max_text_width = int(size * 0.8)
-    words = text.split()
-    lines = []
-    current_line = ""
-    dummy_img = Image.new("RGBA", (max_text_width, fontsize), (0, 0, 0, 0))
-    draw = ImageDraw.Draw(dummy_img)
-    for word in words:
-        test_line = f"{current_line} {word}".strip() if current_line else word
-        bbox = draw.textbbox((0, 0), test_line, font=font)
-        w = bbox[2] - bbox[0]
-        if w <= max_text_width:
-            current_line = test_line
-        else:
-            if current_line:
-                lines.append(current_line)
-            current_line = word
-    if current_line:
-        lines.append(current_line)
-
-    total_height = len(lines) * (fontsize + 5)
-    text_img = Image.new("RGBA", (max_text_width, total_height), (0, 0, 0, 0))
-    with Pilmoji(text_img) as pilmoji:
-        y_text = 0
-        for line in lines:
-            text_size = pilmoji.getsize(line, font=font)
-            w = text_size[0]
-            x_text = (max_text_width - w) // 2
-            pilmoji.text(
-                (x_text, y_text),
-                line,
-                font=font,
-                fill="white",
-                stroke_width=2,
-                stroke_fill="black",
-            )
-            y_text += fontsize + 5
-
-    text_clip = ImageClip(np.array(text_img)).set_duration(clip.duration)
-    text_clip = text_clip.set_position("center")
-    final_clip = CompositeVideoClip([clip, text_clip])
-    if clip.audio:
-        final_clip = final_clip.set_audio(clip.audio)
-    final_clip.write_videofile(
-        temp_output.name, codec="libx264", audio_codec="aac", verbose=False, logger=None
+        logging.warning(f"Could not delete draft channel message {data['current_channel_msg_id']}: {e}")
+    await delete_video(data["edit_video_id"])
+
+
+def format_preview_caption(text: Optional[str], caption: Optional[str], effect) -> str:
+    effect_emoji = AVAILABLE_EFFECTS.get(effect, {}).get("emoticon") if effect else None
+    return (
+        f"{BUTTONS['create:text']}: {html.escape(text) if text else EMPTY_VALUE}\n"
+        f"{BUTTONS['create:caption']}: {html.escape(caption) if caption else EMPTY_VALUE}\n"
+        f"{BUTTONS['create:effect']}: {effect_emoji or EMPTY_VALUE}"
     )
-    clip.close()
-    final_clip.close()
-    cleanup_file(input_path)
-    return temp_output.name
 
 
 async def send_video_note_to_channel(
     bot: Bot,
     video: FSInputFile,
     duration: int,
-    user: types.User,
-    caption: str,
-    caption_up: bool,
-    effect_id: int,
+    user: Optional[types.User],
 ):
     if not CHANNEL_ID:
         raise ValueError("CHANNEL_ID is not set in environment.")
@@ -479,7 +2455,6 @@ async def send_video_note_to_channel(
         video_note=video,
         duration=duration,
         disable_notification=True,
-        message_effect_id=effect_id,
     )
 
     # Return the full message object so the caller can get message_id and file_id
@@ -496,15 +2471,138 @@ def is_valid_url(url: str) -> bool:
         return False
 
 
+# ----- URL INGEST -----
+# Query parameters that only track where a link was shared from, per host.
+# Anything not listed here may select the video, so it stays in the key.
+TRACKING_PARAMS = {
+    "youtube.com": {"si", "feature"},
+    "youtu.be": {"si", "feature"},
+    "x.com": {"s", "t"},
+    "twitter.com": {"s", "t"},
+    "instagram.com": {"igsh", "igshid"},
+    "tiktok.com": {"is_from_webapp", "sender_device"},
+}
+# Ad click ids, tracking on any host
+GLOBAL_TRACKING_PARAMS = {"fbclid", "gclid"}
+
+
+def is_tracking_param(host: str, name: str) -> bool:
+    return (
+        name in GLOBAL_TRACKING_PARAMS
+        or name.startswith("utm_")
+        or name in TRACKING_PARAMS.get(host, ())
+    )
+
+
+def normalize_url(url: str) -> str:
+    """Canonical form of a video link, used only as the URL cache key."""
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or "").lower()
+    for prefix in ("www.", "m.", "mobile."):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+            break
+    path = parts.path.rstrip("/") or "/"
+    query = [
+        (name, value)
+        for name, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not is_tracking_param(host, name)
+    ]
+    video_id = path.lstrip("/")
+    if host == "youtu.be" and video_id and "/" not in video_id:
+        host, query = "youtube.com", [("v", video_id)] + query
+        path = "/watch"
+    elif host == "youtube.com" and path.startswith("/shorts/"):
+        query = [("v", path[len("/shorts/"):])] + query
+        path = "/watch"
+    if parts.port and parts.port not in (80, 443):
+        host = f"{host}:{parts.port}"
+    return urlunsplit(("https", host, path, urlencode(sorted(query)), ""))
+
+
+class UrlIngest(NamedTuple):
+    file_id: str
+    # sha256 of the download, which keeps the original in the media cache
+    unique_id: str
+    # Whole seconds of the original, which may run over the note limit
+    duration: int
+    # Set only for the call that uploaded the note
+    channel_message: Optional[Message] = None
+
+
+URL_CACHE_STATS = {"hits": 0, "misses": 0}
+
+
+async def get_cached_url(url: str) -> Optional[UrlIngest]:
+    row = await db.fetchone(
+        "SELECT file_id, unique_id, duration FROM url_cache WHERE url = ? AND created_at >= ?",
+        (url, int(time.time()) - URL_CACHE_TTL),
+    )
+    URL_CACHE_STATS["hits" if row else "misses"] += 1
+    return UrlIngest(*row) if row else None
+
+
+async def store_cached_url(url: str, ingest: UrlIngest):
+    now = int(time.time())
+    await db.execute(
+        """INSERT OR REPLACE INTO url_cache (url, file_id, unique_id, duration, created_at)
+           VALUES (?, ?, ?, ?, ?)""",
+        (url, ingest.file_id, ingest.unique_id, ingest.duration, now),
+    )
+    await db.execute("DELETE FROM url_cache WHERE created_at < ?", (now - URL_CACHE_TTL,))
+
+
+url_ingests = SingleFlight()
+
+
+async def ingest_url(bot: Bot, key: str, url: str, user_id: int) -> UrlIngest:
+    """Download, crop and upload `url` once, then serve it from the URL cache.
+
+    `key` is the normalized form of `url`; the link itself is fetched as sent.
+    """
+    cached = await get_cached_url(key)
+    if cached:
+        logging.info(f"URL cache hit for {key}")
+        return cached
+
+    with await scratch.job() as job:
+        download = await download_url_video(url, job.file(".mp4"))
+        unique_id = "sha256:" + await asyncio.to_thread(file_sha256, download)
+        # The original stays in the media cache as the session source, so
+        # Apply renders from it instead of the uploaded note
+        with media_cache.pinned(unique_id):
+            path = await media_cache.add(unique_id, download)
+            probed = await asyncio.to_thread(probe_duration, path)
+            transforms = [{"op": "crop"}]
+            if probed > MAX_VIDEO_NOTE_DURATION:
+                transforms = set_session_transform(transforms, "trim", duration=MAX_VIDEO_NOTE_DURATION)
+            duration = int(probed)
+            source = {"path": path, "unique_id": unique_id}
+            video, rendered_path, cache_key = await get_or_render(
+                bot, source, build_render_spec(transforms), job, user_id=user_id
+            )
+            # Whole seconds only for the duration Telegram shows
+            channel_message = await send_video_note_to_channel(
+                bot, video, min(duration, MAX_VIDEO_NOTE_DURATION), None
+            )
+
+    note = channel_message.video_note
+    if rendered_path:
+        await store_cached_render(cache_key, unique_id, note.file_id)
+    ingest = UrlIngest(note.file_id, unique_id, duration)
+    await store_cached_url(key, ingest)
+    return ingest._replace(channel_message=channel_message)
+
+
 # ----- HANDLERS -----
 @router.message(CommandStart())
 async def start(message: Message):
-    add_user(
+    await add_user(
         message.from_user.id,
         message.from_user.username or "",
         message.from_user.first_name or "",
     )
-    initialize_user_templates(message.from_user.id)
+    await initialize_user_templates(message.from_user.id)
     await message.answer(TEXTS["welcome"], reply_markup=main_kb())
 
 
@@ -518,109 +2616,93 @@ async def create_new(message: Message, state: FSMContext):
     await state.set_state(CreateVideoNote.idle)
 
 
-@router.message(F.video | F.video_note | F.text) # Handle video, note, or text URL
+@router.message(
+    StateFilter(None, CreateVideoNote.idle),
+    F.video | F.video_note | (F.text & ~F.text.in_(CONTROL_TEXTS)), # Handle video, note, or text URL
+)
 async def handle_video_input(message: Message, state: FSMContext):
-    current_state = await state.get_state()
-    if current_state is not None and current_state.startswith("CreateVideoNote:"):
+    if (await state.get_data()).get("edit_video_id"):
         await message.answer("❌ You are already editing a video note. Please Apply or Cancel first.")
         return
 
     processing_msg = None
-    video_source_for_channel = None
-    vid_path = None # Define vid_path here for broader scope in cleanup
-    processed_vid_path = None # Define processed_vid_path for cleanup
+    source = None
+    preview_path = None
+    channel_message = None
+    job = None
+    transforms = [{"op": "crop"}]
+    timer = StageTimer("handle_video_input")
     video_duration = 0
-    original_input_file_id = None
 
     try:
         processing_msg = await message.answer(TEXTS["processing_video_note"])
 
-        # --- 1. Process Input ---
+        # --- 1. Resolve Source ---
         if message.video:
-            original_input_file_id = message.video.file_id
+            source = {"file_id": message.video.file_id, "unique_id": message.video.file_unique_id}
             video_duration = message.video.duration
-            if message.video.duration > 60:
-                vid_path = await process_video_file_trim(message.bot, message.video.file_id, trim_duration=60)
-                video_duration = 60
-            else:
-                vid_path = await process_video_file(message.bot, message.video.file_id)
-            video_source_for_channel = FSInputFile(vid_path)
 
         elif message.video_note:
-            original_input_file_id = message.video_note.file_id
+            source = {"file_id": message.video_note.file_id, "unique_id": message.video_note.file_unique_id}
             video_duration = message.video_note.duration
-            video_source_for_channel = message.video_note.file_id
 
         elif message.text and is_valid_url(message.text):
-            async with aiohttp.ClientSession() as session:
-                # ... [Cobalt API and download logic - assumed correct for now]
-                api_url = "http://cobalt:8000/api" # Replace with actual URL if different
-                payload = {"url": message.text, "vQuality": "720"} # Adjust payload as needed
-                async with session.post(api_url, json=payload) as response:
-                    if response.status != 200: raise Exception(f"Cobalt API Error {response.status}")
-                    data = await response.json()
-                    if data.get('status') != 'stream': raise Exception(f"Cobalt status: {data.get('status')}")
-                    video_url = data.get('url')
-                    if not video_url: raise Exception("Cobalt did not return URL")
-
-                # Download
-                temp_dl_path_obj = tempfile.NamedTemporaryFile(delete=False, suffix=".mp4")
-                async with session.get(video_url) as vid_response:
-                    if vid_response.status != 200: raise Exception(f"Download failed: {vid_response.status}")
-                    while True:
-                        chunk = await vid_response.content.read(1024*1024) # Read in chunks
-                        if not chunk: break
-                        temp_dl_path_obj.write(chunk)
-                temp_dl_path_obj.close()
-                vid_path = temp_dl_path_obj.name # Original download path
-
-                # Process downloaded file (crop/trim)
-                clip = None
-                processed_vid_path = None # Path after cropping/trimming
-                try:
-                    clip = VideoFileClip(vid_path)
-                    video_duration = int(clip.duration)
-                    original_input_file_id = vid_path # Store original path
-                    if clip.duration > 60:
-                        processed_vid_path = await process_video_file_trim(message.bot, vid_path, trim_duration=60)
-                        video_duration = 60
-                    else:
-                        processed_vid_path = await process_video_file(message.bot, vid_path)
-                finally:
-                    if clip: clip.close()
-                    # Cleanup original download ONLY if processing succeeded and created a new file
-                    if processed_vid_path and vid_path != processed_vid_path:
-                         cleanup_file(vid_path)
-                    elif not processed_vid_path: # If processing failed, cleanup original download
-                         cleanup_file(vid_path)
-
-                if not processed_vid_path: raise Exception("Video processing failed after download.")
-                video_source_for_channel = FSInputFile(processed_vid_path)
+            # Concurrent pastes of the same link share one download and render
+            key = normalize_url(message.text)
+            ingest, shared = await url_ingests.run(
+                key, ingest_url, message.bot, key, message.text.strip(), message.from_user.id
+            )
+            # The original is in the media cache under unique_id; the uploaded
+            # note is only downloaded again if it has been evicted since
+            source = {"file_id": ingest.file_id, "unique_id": ingest.unique_id}
+            video_duration = ingest.duration
+            if not shared:
+                channel_message = ingest.channel_message
+
         else:
             await message.answer(ERRORS["invalid_input"], reply_markup=main_kb())
             if processing_msg: await processing_msg.delete()
             return
 
-        # --- 2. Send to Channel ---
-        if not video_source_for_channel:
-             raise Exception("No video source determined for channel send.")
+        # Durations are whole seconds, so one at the limit may still run over it
+        if video_duration >= MAX_VIDEO_NOTE_DURATION:
+            transforms = set_session_transform(transforms, "trim", duration=MAX_VIDEO_NOTE_DURATION)
+            video_duration = MAX_VIDEO_NOTE_DURATION
 
-        channel_message = await send_video_note_to_channel(
-            message.bot, video_source_for_channel, video_duration,
-            message.from_user, caption=None, caption_up=False, effect_id=None,
-        )
+        timer.mark("resolve")
+        # --- 2. Render Preview ---
+        # Video notes and ingested links are already square and short enough
+        if not message.video:
+            video_source_for_channel = source["file_id"]
+        else:
+            job = await scratch.job()
+            video_source_for_channel, preview_path, preview_cache_key = await get_or_render(
+                message.bot, source, build_render_spec(transforms, "preview"), job,
+                user_id=message.from_user.id,
+            )
+
+        timer.mark("render")
+        # --- 3. Send to Channel ---
+        if channel_message is None:
+            channel_message = await send_video_note_to_channel(
+                message.bot, video_source_for_channel, video_duration, message.from_user
+            )
+        if preview_path:
+            await store_cached_render(preview_cache_key, source["unique_id"], channel_message.video_note.file_id)
 
-        # --- 3. Save Initial DB Record ---
-        db_id = add_video_note(
+        timer.mark("channel_upload")
+        # --- 4. Save Initial DB Record ---
+        db_id = await add_video_note(
             user_id=message.from_user.id,
             video_note_file_id=channel_message.video_note.file_id,
             channel_message_id=channel_message.message_id,
-            uploaded_video_file_id=original_input_file_id if isinstance(original_input_file_id, str) else channel_message.video_note.file_id,
+            uploaded_video_file_id=source.get("file_id") or channel_message.video_note.file_id,
             text=None, caption=None, effect=None, duration=video_duration,
             width=channel_message.video_note.length, height=channel_message.video_note.length,
         )
 
-        # --- 4. Send Preview to User ---
+        timer.mark("db")
+        # --- 5. Send Preview to User ---
         preview_caption = format_preview_caption(None, None, None)
         preview_message = await message.answer_video(
              video=channel_message.video_note.file_id,
@@ -628,53 +2710,73 @@ async def handle_video_input(message: Message, state: FSMContext):
              reply_markup=create_inline_kb()
         )
 
-        # --- 5. Update State ---
+        # --- 6. Update State ---
         await state.set_state(CreateVideoNote.idle)
         await state.update_data(
             edit_video_id=db_id,
             preview_message_id=preview_message.message_id,
-            text_overlay_source_id=channel_message.video_note.file_id,
-            current_channel_msg_id=channel_message.message_id
+            current_channel_msg_id=channel_message.message_id,
+            source=source,
+            transforms=transforms,
+            draft_preview=bool(message.video),
         )
+        # Keep the working copy for Apply and text previews
+        media_cache.pin(source["unique_id"], db_id)
 
         # Send the Apply/Cancel reply keyboard
         await message.answer("Use the buttons below to apply or cancel.", reply_markup=create_apply_cancel_kb())
 
-        # --- 6. Cleanup (vid_path or processed_vid_path) ---
-        # Use the correct path variable depending on which one holds the final FSInputFile path
-        path_to_cleanup = None
-        if isinstance(video_source_for_channel, FSInputFile):
-             path_to_cleanup = video_source_for_channel.path
-
-        # Cleanup original vid_path if it exists and wasn't cleaned earlier (e.g., non-URL video input)
-        if vid_path and vid_path != path_to_cleanup and os.path.exists(vid_path):
-             cleanup_file(vid_path)
-        # Cleanup the final processed path used for sending
-        if path_to_cleanup:
-             cleanup_file(path_to_cleanup)
-
         if processing_msg: await processing_msg.delete()
+        timer.mark("reply")
 
     except Exception as e:
-        logging.error(f"Error processing video input: {e}", exc_info=True)
-        await message.answer(ERRORS["error_processing_video_note"])
-        # Enhanced Cleanup on error
-        if vid_path and os.path.exists(vid_path): cleanup_file(vid_path)
-        if processed_vid_path and os.path.exists(processed_vid_path): cleanup_file(processed_vid_path)
+        timer.error(e)
+        if isinstance(e, RenderQueueFull):
+            logging.warning(f"Rejected video input: {e}")
+            await message.answer(ERRORS["render_queue_full"])
+        else:
+            logging.error(f"Error processing video input: {e}", exc_info=True)
+            await message.answer(ERRORS["error_processing_video_note"])
+        if source: release_session_source({"source": source})
         if processing_msg: await processing_msg.delete()
         await state.clear()
+    finally:
+        if job: job.close()
+        timer.finish()
 
 
 @router.callback_query(F.data.startswith("create:text"))
 async def modify_text(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
-    if not data.get("raw_video_file_id"):
+    if not data.get("edit_video_id"):
         await callback.answer("No video found to update.", show_alert=True)
         await state.clear()
         return
-    new_text = callback.message.text.strip()
-    await state.update_data(overlay_text=new_text)
-    await callback.answer(SUCCESS["text_updated"], show_alert=True)
+    await state.set_state(CreateVideoNote.waiting_for_text)
+    await callback.message.answer("Send the text to put over the video.")
+    await callback.answer()
+
+
+@router.message(CreateVideoNote.waiting_for_text, F.text & ~F.text.in_(CONTROL_TEXTS))
+async def receive_text(message: Message, state: FSMContext):
+    data = await state.get_data()
+    new_text = message.text.strip()
+    transforms = set_session_transform(data.get("transforms", []), "text", text=new_text)
+    await state.update_data(transforms=transforms)
+    await state.set_state(CreateVideoNote.idle)
+
+    # A still with the overlay stands in for the video until Apply renders it
+    try:
+        frame_path = await get_preview_frame(message.bot, data, message.from_user.id)
+        await state.update_data(preview_frame=frame_path)
+        with await scratch.job() as job:
+            still_path = await render_service.submit(
+                message.from_user.id, render_text_still, frame_path, job.file(".jpg"), new_text
+            )
+            await message.answer_photo(FSInputFile(still_path), caption=SUCCESS["text_updated"])
+    except Exception as e:
+        logging.warning(f"Could not render text preview: {e}")
+        await message.answer(SUCCESS["text_updated"])
 
 
 @router.callback_query(F.data.startswith("create:caption"))
@@ -685,301 +2787,349 @@ async def modify_caption(callback: CallbackQuery, state: FSMContext):
         await callback.answer("No video found to update.", show_alert=True)
         await state.clear()
         return
-    new_caption = callback.message.text.strip()
-    with sqlite3.connect(DATABASE) as conn:
-        conn.execute(
-            "UPDATE video_notes SET caption = ? WHERE id = ?",
-            (new_caption, edit_video_id),
-        )
-        conn.commit()
-    await callback.answer(SUCCESS["caption_updated"], show_alert=True)
+    await state.set_state(CreateVideoNote.waiting_for_caption)
+    await callback.message.answer("Send the caption for the video note.")
+    await callback.answer()
+
+
+@router.message(CreateVideoNote.waiting_for_caption, F.text & ~F.text.in_(CONTROL_TEXTS))
+async def receive_caption(message: Message, state: FSMContext):
+    data = await state.get_data()
+    new_caption = message.text.strip()
+    try:
+        await update_video_note_field(data["edit_video_id"], "caption", new_caption)
+    except Exception as e:
+        logging.error(f"Error updating caption: {e}")
+        await message.answer(ERRORS["error_updating_caption"])
+        return
+    await state.set_state(CreateVideoNote.idle)
+    await message.answer(SUCCESS["caption_updated"])
 
 
 @router.callback_query(F.data.startswith("create:effect"))
 async def modify_effect(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
+    if not data.get("edit_video_id"):
+        await callback.answer("No video found to update.", show_alert=True)
+        await state.clear()
+        return
+    await state.set_state(CreateVideoNote.waiting_for_effect)
+    await callback.message.answer("Please send an emoji to apply the effect.")
+    await callback.answer()
 
-    message = await callback.message.answer(
-        "Please send an emoji to apply the effect.",
-        reply_markup=create_kd(placeholder="Send a message with effect you want"),
-    )
-
-    await state.update_data(data)
 
-    await callback.answer(SUCCESS["effect_updated"], show_alert=True)
+@router.message(CreateVideoNote.waiting_for_effect, F.text & ~F.text.in_(CONTROL_TEXTS))
+async def receive_effect(message: Message, state: FSMContext):
+    effect_id = EFFECTS_BY_EMOJI.get(_effect_lookup_key(message.text))
+    if effect_id is None:
+        available = " ".join(effect["emoticon"] for effect in AVAILABLE_EFFECTS.values())
+        await message.answer(ERRORS["unknown_effect"].format(available=available or EMPTY_VALUE))
+        return
+    data = await state.get_data()
+    await update_video_note_field(data["edit_video_id"], "effect", str(effect_id))
+    await state.set_state(CreateVideoNote.idle)
+    await message.answer(SUCCESS["effect_updated"])
 
 
-@router.callback_query(F.data.startswith("create:done"))
-async def done(callback: CallbackQuery, state: FSMContext):
+@router.callback_query(F.data.startswith("create:cancel"))
+async def cancel(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
-    raw_video_file_id = data.get("raw_video_file_id")
-    caption = data.get("caption", "") # Note: Captions aren't directly supported by video notes
-    overlay_text = data.get("overlay_text", "")
-    effect = data.get("effect")
-    video_duration = data.get("video_duration", 0)
-    # original_input_id = data.get("original_input_id") # Retrieve if needed
-
-    if not raw_video_file_id:
-        await callback.answer("Error: No video data found in state.", show_alert=True)
-        await state.clear()
-        return
+    release_session_source(data)
+    await discard_draft(callback.bot, data)
+    await state.clear()
+    await callback.answer(TEXTS["cancelled"], show_alert=True)
 
-    progress_msg = await callback.message.answer(TEXTS["processing_video_note"])
 
-    try:
-        # 1. Apply text overlay if any
-        video_to_send_id = raw_video_file_id
-        processed_path = None
-        if overlay_text:
-            # Apply text overlay to the raw_video_file_id
-            processed_path = await add_text_to_video_file(callback.bot, raw_video_file_id, overlay_text)
-            video_to_send_id = FSInputFile(processed_path)
-        else:
-            # Use the existing file_id if no text overlay needed
-            video_to_send_id = raw_video_file_id
-
-        # 2. Send the final video note to the channel
-        channel_message = await send_video_note_to_channel(
-            callback.bot,
-            video_to_send_id,
-            video_duration,
-            callback.from_user,
-            caption, # Pass caption even if not directly used by video note itself
-            False, # caption_up - irrelevant for video notes
-            effect,
-        )
+async def send_video_listing(message: Message, items: list, delete_action: str, title: str):
+    """Send (row_id, file_id) pairs as numbered media groups plus one delete keyboard."""
+    slots = asyncio.Semaphore(LISTING_CONCURRENCY)
+
+    async def send_group(offset: int, group: list) -> list:
+        async with slots:
+            if len(group) == 1:
+                # send_media_group needs at least two items
+                sent = await message.answer_video(video=group[0][1], caption=str(offset + 1))
+                return [sent]
+            return await message.answer_media_group(
+                media=[
+                    InputMediaVideo(media=file_id, caption=str(offset + index + 1))
+                    for index, (_, file_id) in enumerate(group)
+                ]
+            )
 
-        # 3. Save details to the database
-        add_video_note(
-            user_id=callback.from_user.id,
-            video_note_file_id=channel_message.video_note.file_id, # Use file_id from channel msg
-            channel_message_id=channel_message.message_id, # Use message_id from channel msg
-            uploaded_video_file_id=raw_video_file_id, # Store the preview/processed ID
-            text=overlay_text,
-            caption=caption,
-            effect=effect,
-            duration=video_duration,
-            width=channel_message.video_note.width, # Get dimensions from channel msg
-            height=channel_message.video_note.height,
+    groups = [
+        items[offset:offset + MEDIA_GROUP_SIZE]
+        for offset in range(0, len(items), MEDIA_GROUP_SIZE)
+    ]
+    sent_groups = await asyncio.gather(
+        *(send_group(index * MEDIA_GROUP_SIZE, group) for index, group in enumerate(groups))
+    )
+    sent_messages = [sent for group in sent_groups for sent in group]
+    buttons = [
+        InlineKeyboardButton(
+            text=f"🗑 {index + 1}",
+            callback_data=f"{delete_action}:{row_id}:{sent.message_id}",
         )
+        for index, ((row_id, _), sent) in enumerate(zip(items, sent_messages))
+    ]
+    rows = [
+        buttons[offset:offset + LISTING_BUTTONS_PER_ROW]
+        for offset in range(0, len(buttons), LISTING_BUTTONS_PER_ROW)
+    ]
+    await message.answer(title, reply_markup=InlineKeyboardMarkup(inline_keyboard=rows))
 
-        # 4. Send confirmation to the user with the template button
-        # Note: Sending the video again to the user might be redundant if preview was shown
-        # Sending just a confirmation message.
-        inline_kb = InlineKeyboardMarkup(
-            inline_keyboard=[
-                [
-                    InlineKeyboardButton(
-                        text=BUTTONS["create:template"],
-                        # Use the file_id from the CHANNEL message for the template
-                        callback_data=f"template_save|{channel_message.video_note.file_id}",
-                    )
-                ]
-            ]
-        )
-        await callback.message.answer(
-            text=SUCCESS["video_note_created"],
-            reply_markup=inline_kb,
-        )
 
-    except Exception as e:
-        logging.error(f"Error finalizing video note: {e}")
-        await callback.answer(ERRORS["error_processing_video_note"], show_alert=True)
-    finally:
-        # Cleanup the temporary file if text overlay was applied
-        if processed_path:
-            cleanup_file(processed_path)
-        await progress_msg.delete()
-        await state.clear()
+def parse_delete_callback(data: str) -> tuple:
+    """Split "<section>:delete:<row_id>:<message_id>" into (row_id, message_id)."""
+    _, _, row_id, message_id = data.split(":")
+    return int(row_id), int(message_id)
 
 
-@router.callback_query(F.data.startswith("create:cancel"))
-async def cancel(callback: CallbackQuery, state: FSMContext):
-    await state.clear()
-    await callback.answer(TEXTS["cancelled"], show_alert=True)
+async def finish_listing_delete(callback: CallbackQuery, message_id: int, empty_text: str):
+    """Drop the deleted item from the chat and its button from the listing keyboard."""
+    try:
+        await callback.bot.delete_message(callback.message.chat.id, message_id)
+    except Exception as e:
+        logging.warning(f"Could not delete listing message {message_id}: {e}")
+    rows = [
+        [button for button in row if button.callback_data != callback.data]
+        for row in callback.message.reply_markup.inline_keyboard
+    ]
+    rows = [row for row in rows if row]
+    if rows:
+        await callback.message.edit_reply_markup(
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=rows)
+        )
+    else:
+        await callback.message.edit_text(empty_text)
 
 
-@router.callback_query(F.data.startswith("template"))
-async def list_templates(callback: CallbackQuery):
-    templates = get_user_templates(callback.from_user.id)
+@router.message(F.text == BUTTONS["template"])
+async def list_templates(message: Message):
+    templates = await get_user_templates(message.from_user.id)
     if not templates:
-        await callback.answer(TEXTS["no_templates"], show_alert=True)
+        await message.answer(TEXTS["no_templates"], reply_markup=main_kb())
         return
-    await callback.message.answer(
-        TEXTS["your_templates"], reply_markup=main_kb()
+    await send_video_listing(
+        message,
+        [(template.id, template.video_file_id) for template in templates[:LISTING_LIMIT]],
+        "template:delete",
+        TEXTS["your_templates"],
     )
-    for template in templates:
-        kb = InlineKeyboardMarkup(
-            inline_keyboard=[
-                [
-                    InlineKeyboardButton(
-                        text="Delete", callback_data=f"delete_template_{template['id']}"
-                    )
-                ]
-            ]
-        )
-        await callback.message.answer_video(
-            video=template["video_file_id"],
-            caption="",
-            reply_markup=kb,
-        )
-    await callback.answer()
 
 
-@router.callback_query(F.data.startswith("template:delete"))
+@router.callback_query(F.data.startswith("template:delete:"))
 async def delete_template(callback: CallbackQuery):
     try:
-        parts = callback.data.split("_")
-        if len(parts) < 3:
-            await callback.answer("Invalid callback data", show_alert=True)
+        template_id, message_id = parse_delete_callback(callback.data)
+        if not await delete_template_db(template_id, callback.from_user.id):
+            await callback.answer("❌ Template not found", show_alert=True)
             return
-        template_id = int(parts[2])
-        delete_template_db(template_id)
-        await callback.message.delete()
-        await callback.answer(TEXTS["template_deleted"], show_alert=True)
+        await finish_listing_delete(callback, message_id, TEXTS["no_templates"])
+        await callback.answer(TEXTS["template_deleted"])
     except Exception as e:
         logging.error(f"Error in delete template callback: {e}")
         await callback.answer("❌ Error deleting template", show_alert=True)
 
 
-async def list_recent(callback: CallbackQuery):
-    videos = get_user_videos(callback.from_user.id)
+@router.message(F.text == BUTTONS["recent"])
+async def list_recent(message: Message):
+    videos = await get_user_videos(message.from_user.id, limit=LISTING_LIMIT)
     if not videos:
-        await callback.answer(TEXTS["no_recent_videos"], show_alert=True)
+        await message.answer(TEXTS["no_recent_videos"], reply_markup=main_kb())
         return
-    for video in videos:
-        await callback.message.answer_video(
-            video=video["video_note_file_id"],
-            caption="",
-            reply_markup=main_kb(),
-        )
-    await callback.answer()
+    await send_video_listing(
+        message,
+        [(video.id, video.video_note_file_id) for video in videos],
+        "recent:delete",
+        TEXTS["your_recent_videos"],
+    )
 
 
-@router.callback_query(F.data.startswith("recent:delete"))
+@router.callback_query(F.data.startswith("recent:delete:"))
 async def delete_recent(callback: CallbackQuery):
     try:
-        parts = callback.data.split("_")
-        if len(parts) < 3:
-            await callback.answer("Invalid callback data", show_alert=True)
-            return
-        video_id = int(parts[2])
-        header_msg_id = int(parts[3]) if len(parts) > 3 else None
-        video = get_video_by_id(video_id)
-        if not video:
+        video_id, message_id = parse_delete_callback(callback.data)
+        video = await get_video_by_id(video_id)
+        if not video or video.user_id != callback.from_user.id:
             await callback.answer("❌ Video not found", show_alert=True)
             return
-        if video["channel_message_id"]:
-            channel_msg_id = video["channel_message_id"]
-            try:
-                # Attempt to delete the video note message
-                await callback.bot.delete_message(CHANNEL_ID, channel_msg_id)
-                # Check if the next message is a text message and delete it
-                next_msg = await callback.bot.get_message(
-                    CHANNEL_ID, channel_msg_id + 1
-                )
-                if "💬" in next_msg.text:
-                    await callback.bot.delete_message(CHANNEL_ID, channel_msg_id + 1)
-            except Exception as e:
-                logging.warning(f"Could not delete channel messages: {e}")
-        delete_video(video_id)
-        try:
-            await callback.message.delete()
-        except Exception as e:
-            logging.warning(f"Could not delete message: {e}")
-        remaining_videos = get_user_videos(callback.from_user.id)
-        if not remaining_videos and header_msg_id:
+        if video.channel_message_id:
             try:
-                await callback.bot.delete_message(
-                    chat_id=callback.message.chat.id, message_id=header_msg_id
-                )
-                await callback.bot.send_message(
-                    chat_id=callback.message.chat.id,
-                    text=TEXTS["no_recent_videos"],
-                    reply_markup=main_kb(),
-                )
+                await callback.bot.delete_message(CHANNEL_ID, video.channel_message_id)
             except Exception as e:
-                logging.warning(f"Could not delete header message: {e}")
-        await callback.answer(TEXTS["video_deleted"], show_alert=True)
+                logging.warning(f"Could not delete channel message: {e}")
+        await delete_video(video_id)
+        await finish_listing_delete(callback, message_id, TEXTS["no_recent_videos"])
+        await callback.answer(TEXTS["video_deleted"])
     except Exception as e:
         logging.error(f"Error in delete recent callback: {e}")
         await callback.answer("❌ Error deleting video", show_alert=True)
 
 
+async def get_inline_entries(user_id: int) -> dict:
+    entry = _inline_cache.get(user_id)
+    if entry and time.monotonic() - entry["loaded_at"] < INLINE_CACHE_TTL:
+        return entry
+    recent_videos = await get_user_videos(user_id, limit=INLINE_RECENT_LIMIT)
+    templates = await get_user_templates(user_id)
+    entry = {
+        "loaded_at": time.monotonic(),
+        # Recent results don't depend on the query, so they are built once
+        "recent": [
+            InlineQueryResultCachedMpeg4Gif(
+                id=f"recent_{video.id}",
+                mpeg4_file_id=video.video_note_file_id,
+                title=f"Recent Video {idx + 1}",
+                caption=format_preview_caption(video.text, video.caption, video.effect),
+                parse_mode=ParseMode.HTML,
+            )
+            for idx, video in enumerate(recent_videos)
+        ],
+        "templates": templates,
+    }
+    _inline_cache.put(user_id, entry)
+    return entry
+
+
 async def inline_query_handler(inline_query: InlineQuery):
+    timer = StageTimer("inline_query_handler")
     user_id = inline_query.from_user.id
     query_text = inline_query.query.strip()
-    results = []
-    recent_videos = get_user_videos(user_id, limit=5)
-    for idx, video in enumerate(recent_videos):
-        caption = format_preview_text(
-            text=video["text"] or "",
-            caption=video["caption"] or "",
-            effect=video["effect"] or "",
-        )
-        result = InlineQueryResultCachedMpeg4Gif(
-            id=f"recent_{video['id']}",
-            mpeg4_file_id=video["video_note_file_id"],
-            title=f"Recent Video {idx + 1}",
-            caption=caption,
-            parse_mode=ParseMode.HTML,
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+    try:
+        entries = await get_inline_entries(user_id)
+        timer.mark("lookup")
+
+        # Recent videos come first, then templates captioned with the query
+        recent = entries["recent"]
+        templates = entries["templates"] if query_text else []
+        total = len(recent) + len(templates)
+        end = min(offset + INLINE_PAGE_SIZE, total)
+        results = recent[offset:end]
+        for idx in range(max(offset, len(recent)), end):
+            template_idx = idx - len(recent)
+            template = templates[template_idx]
+            results.append(
+                InlineQueryResultCachedMpeg4Gif(
+                    id=f"template_{template.id}",
+                    mpeg4_file_id=template.video_file_id,
+                    title=f"Template {template_idx + 1}",
+                    caption=query_text,
+                    input_message_content=InputTextMessageContent(
+                        message_text=query_text,
+                        parse_mode=ParseMode.HTML,
+                    ),
+                )
+            )
+        timer.mark("build")
+        await inline_query.answer(
+            results,
+            cache_time=INLINE_ANSWER_CACHE_TIME,
+            is_personal=True,
+            next_offset=str(end) if end < total else "",
+            switch_pm_text="Open bot",
+            switch_pm_parameter="start",
         )
-        results.append(result)
-    if query_text:
-        templates = get_user_templates(user_id)
-        for idx, template in enumerate(templates):
-            result = InlineQueryResultCachedMpeg4Gif(
-                id=f"template_{idx}_{user_id}",
-                mpeg4_file_id=template["video_file_id"],
-                title=f"Template {idx + 1}",
-                caption=query_text,
-                input_message_content=InputTextMessageContent(
-                    message_text=query_text,
-                    parse_mode=ParseMode.HTML,
-                ),
+        timer.mark("answer")
+    except Exception as e:
+        timer.error(e)
+        raise
+    finally:
+        timer.finish()
+
+
+def _effect_lookup_key(emoji: str) -> str:
+    # Users often send emoji with or without the variation selector
+    return emoji.strip().replace("\ufe0f", "")
+
+
+def set_available_effects(effects: dict):
+    AVAILABLE_EFFECTS.clear()
+    AVAILABLE_EFFECTS.update(effects)
+    EFFECTS_BY_EMOJI.clear()
+    for effect_id, effect in effects.items():
+        EFFECTS_BY_EMOJI.setdefault(_effect_lookup_key(effect["emoticon"]), effect_id)
+
+
+async def load_cached_effects() -> int:
+    """Loads the effects catalog stored by the last refresh and returns its hash."""
+    row = await db.fetchone(
+        "SELECT hash, payload FROM catalog_cache WHERE name = ?", (EFFECTS_CATALOG,)
+    )
+    if not row:
+        return 0
+    set_available_effects(json.loads(row[1]))
+    logging.info(f"Loaded {len(AVAILABLE_EFFECTS)} cached message effects")
+    return row[0]
+
+
+async def _connect_effects_client():
+    from telethon import TelegramClient, errors
+
+    client = TelegramClient("wiikotbot", int(API_ID), API_HASH)
+    await client.connect()
+    if not await client.is_user_authorized():
+        await client.send_code_request(PHONE_NUMBER)
+        logging.warning("Please check your Telegram app for the code.")
+        # getpass blocks, so prompt from a thread and keep the event loop running
+        code = await asyncio.to_thread(getpass.getpass, "Enter the code you received: ")
+        try:
+            await client.sign_in(PHONE_NUMBER, code)
+        except errors.SessionPasswordNeededError:
+            password = TWO_FA_PASSWORD or await asyncio.to_thread(
+                getpass.getpass, "Enter your 2FA password: "
             )
-            results.append(result)
-    await inline_query.answer(
-        results,
-        cache_time=300,
-        is_personal=True,
-        switch_pm_text="Open bot",
-        switch_pm_parameter="start",
+            await client.sign_in(password=password)
+    return client
+
+
+async def refresh_available_effects(known_hash: int) -> int:
+    """Revalidates the effects catalog against the server and returns the new hash."""
+    from telethon.tl.functions.messages import GetAvailableEffectsRequest
+    from telethon.tl.types.messages import AvailableEffectsNotModified
+
+    client = await _connect_effects_client()
+    async with client:
+        available_effects = await client(GetAvailableEffectsRequest(hash=known_hash))
+    now = int(time.time())
+    if isinstance(available_effects, AvailableEffectsNotModified):
+        await db.execute(
+            "UPDATE catalog_cache SET updated_at = ? WHERE name = ?", (now, EFFECTS_CATALOG)
+        )
+        logging.info("Message effects catalog is up to date")
+        return known_hash
+
+    effects = {}
+    for effect in available_effects.effects:
+        if hasattr(effect, "emoticon") and hasattr(effect, "id"):
+            # Bot API takes message_effect_id as a string
+            effects[str(effect.id)] = {
+                "emoticon": effect.emoticon,
+                "static_icon_id": effect.static_icon_id,
+                "effect_sticker_id": effect.effect_sticker_id,
+                "effect_animation_id": effect.effect_animation_id,
+                "premium_required": effect.premium_required,
+            }
+    set_available_effects(effects)
+    await db.execute(
+        "INSERT OR REPLACE INTO catalog_cache (name, hash, payload, updated_at) VALUES (?, ?, ?, ?)",
+        (EFFECTS_CATALOG, available_effects.hash, json.dumps(effects), now),
     )
+    logging.info(f"Refreshed message effects catalog: {len(effects)} effects")
+    return available_effects.hash
 
 
-async def get_available_effects() -> dict:
-    global AVAILABLE_EFFECTS
-    try:
-        client = TelegramClient("wiikotbot", int(API_ID), API_HASH)
-        await client.connect()
-        if not await client.is_user_authorized():
-            await client.send_code_request(PHONE_NUMBER)
-            logging.warning("Please check your Telegram app for the code.")
-            code = getpass.getpass("Enter the code you received: ")
-            try:
-                await client.sign_in(PHONE_NUMBER, code)
-            except errors.SessionPasswordNeededError:
-                password = TWO_FA_PASSWORD or getpass.getpass(
-                    "Enter your 2FA password: "
-                )
-                await client.sign_in(password=password)
-        async with client:
-            available_effects = await client(GetAvailableEffectsRequest(hash=123))
-            AVAILABLE_EFFECTS.clear()
-            for effect in available_effects.effects:
-                if hasattr(effect, "emoticon") and hasattr(effect, "id"):
-                    AVAILABLE_EFFECTS[effect.id] = {
-                        "emoticon": effect.emoticon,
-                        "static_icon_id": effect.static_icon_id,
-                        "effect_sticker_id": effect.effect_sticker_id,
-                        "effect_animation_id": effect.effect_animation_id,
-                        "premium_required": effect.premium_required,
-                    }
-            return AVAILABLE_EFFECTS
-    except Exception as e:
-        logging.error(f"Error getting available effects: {e}")
-        return {}
+async def keep_effects_fresh(known_hash: int):
+    if not API_ID or not API_HASH:
+        logging.warning("API_ID/API_HASH are not set, message effects won't be refreshed.")
+        return
+    while True:
+        try:
+            known_hash = await refresh_available_effects(known_hash)
+        except Exception as e:
+            logging.error(f"Error getting available effects: {e}")
+        await asyncio.sleep(EFFECTS_REFRESH_INTERVAL)
 
 
 async def handle_invalid_input(message: Message):
@@ -1050,7 +3200,7 @@ async def save_template(callback: CallbackQuery, state: FSMContext):
             await callback.answer("Invalid data", show_alert=True)
             return
         video_note_id = parts[1]
-        add_template(callback.from_user.id, video_note_id)
+        await add_template(callback.from_user.id, video_note_id)
         await callback.answer(SUCCESS["template_saved"], show_alert=True)
     except Exception as e:
         logging.error(f"Error saving template: {e}")
@@ -1076,10 +3226,11 @@ async def apply_changes(message: Message, state: FSMContext):
     data = await state.get_data()
     edit_video_id = data.get("edit_video_id")
     current_channel_msg_id = data.get("current_channel_msg_id")
-    text_overlay_source_id = data.get("text_overlay_source_id")
+    source = data.get("source")
+    transforms = data.get("transforms", [])
     preview_message_id = data.get("preview_message_id") # ID of the message with inline keyboard
 
-    if not edit_video_id or not current_channel_msg_id or not text_overlay_source_id:
+    if not edit_video_id or not current_channel_msg_id or not source:
         await message.answer(ERRORS["no_video_in_state"])
         # Potentially remove reply keyboard here if needed
         await state.clear()
@@ -1088,52 +3239,67 @@ async def apply_changes(message: Message, state: FSMContext):
     # Use message.answer for progress
     progress_msg = await message.answer(TEXTS["processing_video_note"])
     final_processed_path = None
+    new_channel_message = None
+    session_done = True
+    job = None
+    timer = StageTimer("apply_changes")
 
     try:
-        # ... [Steps 1-5: Fetch data, determine source, delete old, send new, update DB - remain the same] ...
         # 1. Fetch final data from DB
-        final_video_data = get_video_by_id(edit_video_id)
+        final_video_data = await get_video_by_id(edit_video_id)
         if not final_video_data:
             raise Exception(f"Could not retrieve final video data for DB ID {edit_video_id}")
-        final_text = final_video_data.get("text")
-        final_caption = final_video_data.get("caption")
-        final_effect = final_video_data.get("effect")
-        final_duration = final_video_data.get("duration")
+        final_caption = final_video_data.caption
+        final_effect = final_video_data.effect
+        final_duration = final_video_data.duration
 
+        timer.mark("db_load")
         # 2. Determine final video source
+        # The preview already has crop + trim applied, so only an overlay or a
+        # draft-quality preview needs a render, done from the original source
+        # in one encode with the final profile.
         video_source_for_final_send = None
-        if final_text:
-            final_processed_path = await add_text_to_video_file(
-                message.bot, text_overlay_source_id, final_text
+        final_spec = build_render_spec(transforms)
+        if final_spec.text or data.get("draft_preview"):
+            job = await scratch.job()
+            video_source_for_final_send, final_processed_path, cache_key = await get_or_render(
+                message.bot, source, final_spec, job, user_id=message.from_user.id
             )
-            video_source_for_final_send = FSInputFile(final_processed_path)
         else:
-            video_source_for_final_send = final_video_data.get("video_note_file_id")
+            video_source_for_final_send = final_video_data.video_note_file_id
         if not video_source_for_final_send:
             raise Exception("Could not determine video source for final channel send.")
 
-        # 3. Delete old channel message
+        timer.mark("render")
+        # 3. Send new video note to channel
+        new_channel_message = await send_video_note_to_channel(
+            message.bot, video_source_for_final_send, final_duration, message.from_user,
+        )
+        if final_processed_path:
+            await store_cached_render(cache_key, source["unique_id"], new_channel_message.video_note.file_id)
+
+        timer.mark("channel_upload")
+        # 4. Delete old channel message, only once its replacement is posted
         try:
             await message.bot.delete_message(CHANNEL_ID, current_channel_msg_id)
         except Exception as e:
             logging.warning(f"Could not delete old channel message {current_channel_msg_id}: {e}")
 
-        # 4. Send new video note to channel
-        new_channel_message = await send_video_note_to_channel(
-            message.bot, video_source_for_final_send, final_duration,
-            message.from_user, final_caption, False, final_effect,
-        )
-
+        timer.mark("channel_delete")
         # 5. Update DB
-        update_success_vid_id = update_video_note_field(
+        update_success_vid_id = await update_video_note_field(
             edit_video_id, "video_note_file_id", new_channel_message.video_note.file_id
         )
-        update_success_msg_id = update_video_note_field(
+        update_success_msg_id = await update_video_note_field(
             edit_video_id, "channel_message_id", new_channel_message.message_id
         )
-        if not update_success_vid_id or not update_success_msg_id:
+        update_success_text = await update_video_note_field(
+            edit_video_id, "text", final_spec.text
+        )
+        if not update_success_vid_id or not update_success_msg_id or not update_success_text:
             logging.error(f"Failed to update channel message/file ID in DB for {edit_video_id}")
 
+        timer.mark("db_update")
         # 6. Send confirmation to user & Remove Reply Keyboard
         template_button_kb = InlineKeyboardMarkup(
             inline_keyboard=[
@@ -1145,6 +3311,11 @@ async def apply_changes(message: Message, state: FSMContext):
                 ]
             ]
         )
+        # Message effects only play in private chats, so the user's copy carries it
+        await send_final(
+            message.bot, message.chat.id, new_channel_message.video_note.file_id,
+            final_caption, False, final_effect,
+        )
         # Send confirmation as a new message, remove reply keyboard
         await message.answer(
             TEXTS["changes_applied"],
@@ -1159,28 +3330,32 @@ async def apply_changes(message: Message, state: FSMContext):
                 await message.bot.delete_message(message.chat.id, preview_message_id)
             except Exception as e:
                 logging.warning(f"Could not delete preview message {preview_message_id}: {e}")
-
+        timer.mark("reply")
+
+    except RenderQueueFull as e:
+        timer.error(e)
+        logging.warning(f"Rejected apply: {e}")
+        await message.answer(ERRORS["render_queue_full"])
+        # Nothing was posted yet, so the session stays open for another Apply
+        session_done = False
     except Exception as e:
+        timer.error(e)
         logging.error(f"Error applying changes: {e}", exc_info=True)
         await message.answer(ERRORS["error_applying_changes"])
         # Keep reply keyboard on error?
     finally:
-        if final_processed_path:
-            cleanup_file(final_processed_path)
+        if job: job.close()
         if progress_msg: await progress_msg.delete()
-        await state.clear()
+        if session_done:
+            release_session_source(data)
+            if not new_channel_message:
+                await discard_draft(message.bot, data)
+            await state.clear()
+        timer.finish()
 
 # --- Cancel Handler ---
 # Updated decorator to listen for message text and handle relevant states
-@router.message(
-    CreateVideoNote.idle,
-    CreateVideoNote.waiting_for_text,
-    CreateVideoNote.waiting_for_caption,
-    CreateVideoNote.waiting_for_effect,
-    CreateVideoNote.waiting_for_video,
-    CreateVideoNote.waiting_for_audio,
-    F.text == BUTTONS["create:cancel"]
-)
+@router.message(StateFilter(CreateVideoNote), F.text == BUTTONS["create:cancel"])
 async def cancel_creation(message: Message, state: FSMContext):
     data = await state.get_data()
     preview_msg_id = data.get("preview_message_id")
@@ -1192,6 +3367,8 @@ async def cancel_creation(message: Message, state: FSMContext):
         except Exception as e:
             logging.warning(f"Could not delete preview message {preview_msg_id}: {e}")
 
+    release_session_source(data)
+    await discard_draft(message.bot, data)
     await state.clear()
     # Send confirmation and remove reply keyboard
     await message.answer(TEXTS["cancelled"], reply_markup=types.ReplyKeyboardRemove())
@@ -1204,22 +3381,104 @@ async def cancel_creation(message: Message, state: FSMContext):
 async def invalid_modification_input(message: Message, state: FSMContext):
     await message.answer("Invalid input. Please provide the requested information or cancel.")
 
+# ----- WEBHOOK -----
+class ConcurrencyLimitMiddleware(BaseMiddleware):
+    """Caps how many updates are handled at the same time."""
+
+    def __init__(self, limit: int):
+        self._slots = asyncio.Semaphore(limit)
+
+    async def __call__(self, handler, event, data):
+        async with self._slots:
+            return await handler(event, data)
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+    # Without a secret anyone who can reach the port could post forged updates
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET must be set in webhook mode")
+    dp.update.outer_middleware(ConcurrencyLimitMiddleware(WEBHOOK_CONCURRENCY))
+    app = web.Application()
+    # Requests without the matching X-Telegram-Bot-Api-Secret-Token header get 401
+    SimpleRequestHandler(
+        dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    app.router.add_get(METRICS_PATH, metrics_handler)
+
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+    else:
+        logging.warning("WEBHOOK_URL is not set, not registering the webhook with Telegram.")
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logging.info(f"Listening for updates on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
 # ----- MAIN FUNCTION -----
+async def report_startup():
+    # Fired by the dispatcher right before the first getUpdates call, or when
+    # the webhook server starts accepting requests
+    max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    logging.info(
+        f"Startup: imports {IMPORT_SECONDS:.2f}s, "
+        f"ready for updates after {time.perf_counter() - _PROCESS_STARTED:.2f}s, "
+        f"max RSS {max_rss_mb:.1f} MB"
+    )
+
+
 async def main():
     initialize_db()
+    logging.info(f"Render cache: {await render_cache_stats()}")
+    await asyncio.to_thread(media_cache.load)
+    logging.info(f"Media cache: {media_cache.stats()}")
+    logging.info(f"Scratch space {scratch.root}: swept {await asyncio.to_thread(scratch.sweep)} orphaned jobs")
     bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-    await get_available_effects()
-    await load_default_templates(bot)
-    dp = Dispatcher(storage=MemoryStorage())
+    bot.session.middleware(rate_limiter)
+    effects_hash = await load_cached_effects()
+    effects_task = asyncio.create_task(keep_effects_fresh(effects_hash))
+    templates_task = asyncio.create_task(load_default_templates(bot))
+    fsm_storage = SQLiteStorage(db, FSM_CACHE_SIZE, FSM_TTL, FSM_FLUSH_INTERVAL)
+    fsm_storage.start()
+    dp = Dispatcher(storage=fsm_storage)
 
     dp.include_router(router)
+    dp.startup.register(report_startup)
 
     dp.inline_query.register(inline_query_handler)
 
+    await render_service.start()
+    lag_task = asyncio.create_task(monitor_event_loop_lag())
+    metrics_runner = None
     try:
-        await dp.start_polling(bot)
+        if BOT_MODE == "webhook":
+            # The webhook app serves METRICS_PATH itself
+            await run_webhook(dp, bot)
+        else:
+            if METRICS_PORT:
+                metrics_runner = await start_metrics_server()
+            await dp.start_polling(bot)
     finally:
+        lag_task.cancel()
+        templates_task.cancel()
+        effects_task.cancel()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await render_service.close()
+        await fsm_storage.close()
+        await http_client.close()
         await bot.session.close()
+        db.close()
 
 if __name__ == "__main__":
     asyncio.run(main())